@@ -5,12 +5,15 @@
 """
 
 # Стандартная библиотека
-import argparse, csv, logging, os, re, subprocess, sys, tarfile, time, yaml, math
-from collections import defaultdict
-from concurrent.futures import ThreadPoolExecutor
-from queue import Queue
-from pathlib import Path
-from threading import Lock
+import argparse, csv, errno, gc, grp, heapq, io, logging, multiprocessing, os, pwd, random, re, subprocess, sys, tarfile, time, yaml, math
+from array import array
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
+from itertools import chain, repeat
+from operator import itemgetter
+from queue import SimpleQueue
+from threading import Event, Lock, Thread
 
 # Сторонние библиотеки
 from rich.console import Console
@@ -21,6 +24,7 @@ from rich.logging import RichHandler
 from rich.panel import Panel
 from rich.progress import (BarColumn, Progress, TaskProgressColumn,
                            TextColumn, TimeRemainingColumn, TransferSpeedColumn)
+from rich.progress_bar import ProgressBar
 from rich.prompt import Prompt
 from rich.table import Table
 
@@ -28,7 +32,7 @@ from rich.table import Table
 console = Console()
 __version__ = "6.0.0" # НОВАЯ ВЕРСИЯ
 CONFIG_FILE = "config.yaml"
-status_queue = Queue()
+status_queue = SimpleQueue() # Обновления статуса от потоков; без Condition, put дешевле, чем у Queue
 DEFAULT_CONFIG = {
     'mount_points': ["/mnt/disk1", "/mnt/disk2"],
     'source_root': '/path/to/source/data',
@@ -37,20 +41,38 @@ DEFAULT_CONFIG = {
     'state_file': "copier_state.csv",
     'mapping_file': "mapping.csv",
     'error_log_file': "errors.log",
+    'malformed_lines_file': "malformed_lines.log",
     'dry_run_mapping_file': "dry_run_mapping.csv",
     'threads': 8,
-    'disk_strategy': "round_robin", #or fill
+    'archive_threads': 0, # Потоки архивации секвенций (0 - половина threads, но не меньше 2)
+    'disk_strategy': "round_robin", #or fill, balanced
     'max_concurrent_disks': "2",
     'min_files_for_sequence': 50,
+    'verify_checksum': False, # rsync --checksum при докопировании (медленно: читает файлы целиком)
+    'rsync_batch_size': 512, # Сколько мелких файлов одного каталога копировать одним заданием
+    'rsync_batch_max_file_size': 1048576, # Файлы меньше этого размера (байт) объединяются в пакеты
     'image_extensions': ['dpx', 'cri', 'tiff', 'tif', 'exr', 'png', 'jpg', 'jpeg', 'tga', 'j2c'],
 }
-SEQUENCE_RE = re.compile(r'^(.*?)[\._]*(\d+)\.([a-zA-Z0-9]+)$', re.IGNORECASE)
+MALFORMED_PREVIEW_LINES = 50 # Сколько некорректных строк CSV держать в памяти для просмотра в меню
+FRAME_DIGITS = '0123456789' # Символы номера кадра в имени файла секвенции
+TAR_COPY_BUFSIZE = 2 << 20 # Размер блока при копировании без os.sendfile
+COPY_CHUNK_SIZE = 1 << 22 # Сколько байт копировать за один вызов os.copy_file_range
+TAR_READAHEAD_DEPTH = 4 # На сколько файлов секвенции вперед запрашивать упреждающее чтение
+MANIFEST_READ_SIZE = 1 << 20 # Размер блока чтения манифеста
+PARALLEL_CSV_MIN_BYTES = 64 << 20 # С какого размера манифест разбирается в нескольких процессах
+PARALLEL_SCAN_MIN_DIRS = 1000 # С какого числа каталогов поиск секвенций идет в нескольких процессах
+RSYNC_PROGRESS_RE = re.compile(rb'\s+(\d+)%') # Процент выполнения в выводе rsync --progress
+UNSAFE_NAME_CHARS_RE = re.compile(r'[^\w\.\-]') # Символы, заменяемые на '_' в имени архива секвенции
+RSYNC_READ_SIZE = 1 << 16 # Размер блока чтения вывода rsync
+PANEL_REFRESH_INTERVAL = 0.25 # Как часто (сек) Live перерисовывает и перестраивает панели дашборда
+DISK_USAGE_TTL = 2.0 # Сколько секунд считать результат os.statvfs актуальным
 
 logging.basicConfig(level="INFO", format="%(message)s", datefmt="[%X]", handlers=[RichHandler(rich_tracebacks=True, show_path=False, console=console)])
 log = logging.getLogger("rich")
 
 file_lock = Lock()
-worker_stats = {}
+_created_dirs, _created_dirs_lock = set(), Lock() # Каталоги назначения, уже созданные этим процессом
+worker_stats = [] # Состояние потоков для панели: worker_stats[worker_id - 1]
 
 # --- Основные классы ---
 
@@ -69,18 +91,41 @@ class DiskManager:
         self.active_disk = None
         self.next_disk_index = 0
         self.lock = Lock()
+        self._usage_cache = {} # путь -> (время замера, результат os.statvfs)
+        self._assigned = {} # путь -> байты, отданные заданиям после последнего замера statvfs
+        # Точки монтирования не меняются во время работы - проверяем их наличие один раз
+        self._existing_mounts = [m for m in mount_points if os.path.exists(m)]
 
         log.info(f"Стратегия распределения по дискам: [bold cyan]{self.strategy}[/bold cyan]")
         if self.strategy == 'round_robin':
             log.info(f"Максимальное кол-во одновременно используемых дисков (в приоритете): [bold cyan]{self.max_concurrent_disks}[/bold cyan]")
         self._select_initial_disk()
 
+    def _statvfs(self, path):
+        """Возвращает os.statvfs(path), кэшируя результат на DISK_USAGE_TTL секунд."""
+        now = time.monotonic()
+        # Одна запись на путь: чтение и сброс из разных потоков не требуют блокировки
+        cached = self._usage_cache.get(path)
+        if cached and now - cached[0] < DISK_USAGE_TTL:
+            return cached[1]
+        st = os.statvfs(path)
+        self._usage_cache[path] = (now, st)
+        # Замер, обновленный по истечении TTL, уже учитывает записанное. Принудительный
+        # повторный замер после отказа (_invalidate_usage) обещанные байты не сбрасывает:
+        # задания, выданные мгновение назад, еще не успели записаться
+        if cached: self._assigned[path] = 0
+        return st
+
+    def _invalidate_usage(self, path):
+        """Сбрасывает кэш statvfs для диска, чтобы следующая проверка увидела свежие данные."""
+        self._usage_cache.pop(path, None)
+
     def _get_disk_usage(self, path):
         """Возвращает использование диска в процентах."""
         if self.is_dry_run: return 0.0
-        if not os.path.exists(path): return 100.0
+        if path not in self._existing_mounts: return 100.0
         try:
-            st = os.statvfs(path)
+            st = self._statvfs(path)
             used = (st.f_blocks - st.f_bfree) * st.f_frsize
             total = st.f_blocks * st.f_frsize
             return round(used / total * 100, 2) if total > 0 else 0.0
@@ -89,9 +134,9 @@ class DiskManager:
     def _get_disk_free_space(self, path):
         """Возвращает свободное место на диске в байтах."""
         if self.is_dry_run: return sys.maxsize
-        if not os.path.exists(path): return 0
+        if path not in self._existing_mounts: return 0
         try:
-            st = os.statvfs(path)
+            st = self._statvfs(path)
             return st.f_bavail * st.f_frsize
         except FileNotFoundError:
             return 0
@@ -99,11 +144,14 @@ class DiskManager:
     def _is_disk_suitable(self, mount_path, required_space=0):
         """Проверяет, подходит ли диск по всем критериям (существует, не переполнен, есть место)."""
         if not self.is_dry_run:
-            if not os.path.exists(mount_path):
-                return False
-            if self._get_disk_usage(mount_path) >= self.threshold:
+            if mount_path not in self._existing_mounts:
                 return False
-            if self._get_disk_free_space(mount_path) <= required_space:
+            usage = self._get_disk_usage(mount_path)
+            # Байты, уже обещанные заданиям после замера statvfs (стратегия balanced), тоже заняты
+            free_space = self._get_disk_free_space(mount_path) - self._assigned.get(mount_path, 0)
+            if usage >= self.threshold or free_space <= required_space:
+                # Диск отклонен - не доверяем кэшу при следующей проверке, вдруг место освободилось
+                self._invalidate_usage(mount_path)
                 return False
         return True
 
@@ -146,6 +194,17 @@ class DiskManager:
                 # Если и здесь не нашли, значит места нет нигде
                 raise RuntimeError(f"🛑 Во ВСЕХ дисках не найдено места для файла размером {decimal(job_size)}")
 
+            elif self.strategy == 'balanced':
+                # Worst-fit: задание идет на диск с наибольшим свободным местом. Из места
+                # вычитаются задания, выданные после замера statvfs (он кэшируется), иначе
+                # все задания в пределах DISK_USAGE_TTL ушли бы на один и тот же диск
+                suitable_disks = [m for m in self.mount_points if self._is_disk_suitable(m, job_size)]
+                if not suitable_disks:
+                    raise RuntimeError(f"🛑 Нет доступных дисков для файла размером {decimal(job_size)}.")
+                disk = max(suitable_disks, key=lambda m: self._get_disk_free_space(m) - self._assigned.get(m, 0))
+                self._assigned[disk] = self._assigned.get(disk, 0) + job_size
+                return disk
+
             else:  # Стратегия 'fill'
                 suitable_disks = [m for m in self.mount_points if self._is_disk_suitable(m, job_size)]
                 if not suitable_disks:
@@ -159,6 +218,16 @@ class DiskManager:
 
     def get_all_disks_status(self):
         return [(m, self._get_disk_usage(m)) for m in self.mount_points]
+
+    def get_disk_size(self, path):
+        """Возвращает (занято, всего) в байтах по кэшированному statvfs или None, если диск недоступен."""
+        if path not in self._existing_mounts: return None
+        try:
+            st = self._statvfs(path)
+        except FileNotFoundError:
+            return None
+        total = st.f_blocks * st.f_frsize
+        return total - st.f_bfree * st.f_frsize, total
 # --- Вспомогательные функции ---
 
 def load_config():
@@ -173,58 +242,345 @@ def load_config():
     config['image_extensions'] = set(e.lower() for e in config.get('image_extensions', []))
     return config
 
+def ensure_dir(path):
+    """
+    Создает каталог назначения, если он еще не создавался в этом процессе. Повторный
+    вызов для того же каталога не обращается к файловой системе (makedirs делает stat
+    каждого предка). Гонка безобидна: двойной makedirs с exist_ok=True ничего не ломает.
+    """
+    if path not in _created_dirs:
+        os.makedirs(path, exist_ok=True)
+        with _created_dirs_lock: _created_dirs.add(path)
+
+def csv_line(*fields):
+    """
+    Кодирует строку CSV в байты без модуля csv. Результат совпадает с csv.writer
+    (QUOTE_MINIMAL, окончание строки CRLF), поэтому файлы читаются аудитором как раньше.
+    """
+    quoted = []
+    for field in fields:
+        if '"' in field or ',' in field or '\n' in field or '\r' in field:
+            field = '"' + field.replace('"', '""') + '"'
+        quoted.append(field)
+    return (','.join(quoted) + '\r\n').encode('utf-8')
+
 def load_previous_state(state_file, processed_items_keys):
     if os.path.exists(state_file):
         try:
-            with open(state_file, 'r', encoding='utf-8') as f:
-                for row in csv.reader(f):
-                    if row: processed_items_keys.add(row[0])
+            # Файл читается и декодируется целиком, а не построчно
+            with open(state_file, 'rb') as f:
+                text = f.read().decode('utf-8')
+            lines = text.replace('\r\n', '\n').split('\n')
+            if '"' not in text and ',' not in text:
+                # Обычный случай: в каждой строке только ключ - строки и есть ключи
+                processed_items_keys.update(lines)
+                processed_items_keys.discard('')
+            else:
+                for line in lines:
+                    if not line: continue
+                    if line.startswith('"'):
+                        # Поле в кавычках (путь с запятой или кавычкой) - разбираем как CSV
+                        processed_items_keys.add(next(csv.reader([line]))[0])
+                    else:
+                        processed_items_keys.add(line.partition(',')[0])
             log.info(f"Загружено [bold]{len(processed_items_keys)}[/bold] записей из файла состояния.")
         except Exception as e: log.error(f"Не удалось прочитать файл состояния {state_file}: {e}")
 
-def write_log(state_log_file, mapping_log_file, key, dest_path=None, is_dry_run=False):
+def open_log_files(config, is_dry_run):
+    """
+    Открывает файлы состояния и маппинга на все время работы и возвращает их дескрипторы
+    (O_APPEND: каждая запись дописывается в конец). В dry-run режиме состояние не пишется,
+    а маппинг идет в dry_run_mapping_file.
+    """
+    flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT
+    state_fd = None if is_dry_run else os.open(config['state_file'], flags, 0o644)
+    mapping_fd = os.open(config['dry_run_mapping_file'] if is_dry_run else config['mapping_file'], flags, 0o644)
+    return state_fd, mapping_fd
+
+def write_log(state_fd, mapping_fd, keys, dest_paths=None, is_dry_run=False):
+    """
+    Записывает ключи завершенных заданий одним os.write на каждый файл. Вызывается
+    только из главного потока, который собирает результаты всех заданий за тик
+    цикла. dest_paths - пути назначения в том же порядке, что и keys.
+    """
+    state_blob = b''.join(csv_line(key) for key in keys) if not is_dry_run else b''
+    mapping_blob = b''.join(csv_line(key, dest_path) for key, dest_path in zip(keys, dest_paths)) if dest_paths is not None else b''
+    if state_blob: _write_all(state_fd, state_blob)
+    if mapping_blob: _write_all(mapping_fd, mapping_blob)
+
+def log_file_errors(config, failures):
+    """Дописывает в error_log_file по строке на каждую пару (исходный файл, ошибка)."""
     with file_lock:
-        if not is_dry_run:
-            with open(state_log_file, "a", newline='', encoding='utf-8') as f: csv.writer(f).writerow([key])
-        if dest_path:
-            # В dry-run режиме пишем в dry_run_mapping_file, иначе в обычный mapping_file
-            target_mapping_file = mapping_log_file.replace('mapping.csv', 'dry_run_mapping.csv') if is_dry_run else mapping_log_file
-            with open(target_mapping_file, "a", newline='', encoding='utf-8') as f: csv.writer(f).writerow([key, dest_path])
-
-def find_sequences(dirs, config):
+        with open(config['error_log_file'], "a", encoding='utf-8') as f:
+            for source_file, error in failures:
+                f.write(f"{time.asctime()};{source_file};{error}\n")
+
+def _scan_dir(dir_path, names, sizes, image_extensions, min_files):
+    """Ищет секвенции в одном каталоге. Возвращает (секвенции, множество их файлов)."""
+    sequences, sequence_files = [], set()
+    sequences_in_dir = defaultdict(list)
+    # Храним (кадр, имя, размер); полный путь собирается только для найденных секвенций
+    for filename, file_size in zip(names, sizes):
+        # Имя вида "<префикс>[._]<кадр>.<расширение>" разбирается строковыми операциями:
+        # расширение - после последней точки, кадр - цифры в конце основы имени
+        stem, dot, ext = filename.rpartition('.')
+        if not dot: continue
+        ext = ext.lower()
+        if ext not in image_extensions: continue
+        head = stem.rstrip(FRAME_DIGITS)
+        if len(head) == len(stem): continue
+        sequences_in_dir[(head.rstrip('._'), ext)].append((int(stem[len(head):]), filename, file_size))
+    dir_prefix = os.path.join(dir_path, '')
+    for (prefix, ext), file_tuples in sequences_in_dir.items():
+        if len(file_tuples) >= min_files:
+            file_tuples.sort()
+            min_frame, max_frame = file_tuples[0][0], file_tuples[-1][0]
+            full_paths = [dir_prefix + filename for _, filename, _ in file_tuples]
+            safe_prefix = UNSAFE_NAME_CHARS_RE.sub('_', prefix.strip())
+            tar_filename = f"{safe_prefix}.{min_frame:04d}-{max_frame:04d}.{ext}.tar"
+            virtual_tar_path = dir_prefix + tar_filename
+            sequences.append({'type': 'sequence', 'key': virtual_tar_path, 'dir_path': dir_path, 'tar_filename': tar_filename, 'source_files': full_paths, 'size': sum(t[2] for t in file_tuples)})
+            sequence_files.update(full_paths)
+    return sequences, sequence_files
+
+def _process_pool(max_workers):
+    """
+    Пул процессов, запускаемых через forkserver (или spawn): к моменту создания пула уже
+    работают потоки Rich (автообновление Progress), и fork унаследовал бы захваченные ими
+    блокировки консоли и логирования.
+    """
+    start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context(start_method))
+
+def find_sequences(dir_names, dir_sizes, config):
+    """
+    Ищет секвенции во всех каталогах. Каталоги независимы, поэтому при большом их числе
+    разбор раздается по процессам (ProcessPoolExecutor), чтобы не упираться в GIL.
+    Имена файлов и их размеры хранятся раздельно: dir_names[каталог] - список имен,
+    dir_sizes[каталог] - array('q') размеров в том же порядке.
+    """
+    image_extensions = config.get('image_extensions', set())
+    min_files = config.get('min_files_for_sequence', 50)
     all_sequences, sequence_files = [], set()
-    for dir_path, files_with_sizes in dirs.items():
-        sequences_in_dir = defaultdict(list)
-        for filename, file_size in files_with_sizes:
-            match = SEQUENCE_RE.match(filename)
-            if match and match.group(3).lower() in config.get('image_extensions', set()):
-                prefix, frame, ext = match.groups()
-                sequences_in_dir[(prefix, ext.lower())].append((int(frame), os.path.join(dir_path, filename), file_size))
-        for (prefix, ext), file_tuples in sequences_in_dir.items():
-            if len(file_tuples) >= config.get('min_files_for_sequence', 50):
-                file_tuples.sort()
-                frames, full_paths, sizes = zip(*file_tuples)
-                min_frame, max_frame = min(frames), max(frames)
-                safe_prefix = re.sub(r'[^\w\.\-]', '_', prefix.strip())
-                tar_filename = f"{safe_prefix}.{min_frame:04d}-{max_frame:04d}.{ext}.tar"
-                virtual_tar_path = os.path.join(dir_path, tar_filename)
-                all_sequences.append({'type': 'sequence', 'key': virtual_tar_path, 'dir_path': dir_path, 'tar_filename': tar_filename, 'source_files': list(full_paths), 'size': sum(sizes)})
-                sequence_files.update(full_paths)
+    if len(dir_names) >= PARALLEL_SCAN_MIN_DIRS and (os.cpu_count() or 1) > 1:
+        with _process_pool(os.cpu_count()) as pool:
+            results = pool.map(_scan_dir, dir_names.keys(), dir_names.values(), (dir_sizes[d] for d in dir_names), repeat(image_extensions), repeat(min_files), chunksize=64)
+            for sequences, files in results:
+                all_sequences.extend(sequences); sequence_files.update(files)
+    else:
+        for dir_path, names in dir_names.items():
+            sequences, files = _scan_dir(dir_path, names, dir_sizes[dir_path], image_extensions, min_files)
+            all_sequences.extend(sequences); sequence_files.update(files)
     return all_sequences, sequence_files
 
+def plan_standalone_files(dir_names, dir_sizes, sequence_files, processed_items_keys):
+    """
+    Второй проход по каталогам: файлы, не вошедшие в секвенции и еще не обработанные,
+    становятся заданиями на копирование. Повторы одного файла в источнике отбрасываются.
+    Возвращает (задания, число уникальных файлов).
+    """
+    copy_jobs, total_files = [], 0
+    for dir_path, names in dir_names.items():
+        seen = set()
+        for name, size in zip(names, dir_sizes[dir_path]):
+            if name in seen: continue
+            seen.add(name); total_files += 1
+            path = os.path.join(dir_path, name)
+            if path not in sequence_files and path not in processed_items_keys:
+                copy_jobs.append({'type': 'file', 'key': path, 'size': size})
+    return copy_jobs, total_files
+
+def _write_all(fd, data):
+    """Записывает буфер в fd целиком, повторяя os.write при частичной записи."""
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+def _copy_file_data(src_fd, out_fd, size, offset=0):
+    """
+    Копирует байты [offset, size) из src_fd в текущую позицию out_fd через os.sendfile (в ядре),
+    с откатом на чтение блоками. Если источник оказался короче size, выбрасывает OSError.
+    """
+    start = offset
+    if hasattr(os, 'sendfile'):
+        try:
+            while offset < size:
+                sent = os.sendfile(out_fd, src_fd, offset, size - offset)
+                if sent == 0: break
+                offset += sent
+        except OSError as e:
+            # sendfile в обычный файл поддерживается не везде - тогда копируем вручную
+            if offset != start or e.errno not in (errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK): raise
+    while offset < size:
+        chunk = os.pread(src_fd, min(TAR_COPY_BUFSIZE, size - offset), offset)
+        if not chunk: raise OSError(f"Файл изменился во время чтения (прочитано {offset} из {size} байт)")
+        _write_all(out_fd, chunk)
+        offset += len(chunk)
+
+@lru_cache(maxsize=None)
+def _owner_names(uid, gid):
+    """Имена владельца и группы для заголовка tar. Кэшируются: у кадров секвенции они одни и те же."""
+    try: uname = pwd.getpwuid(uid).pw_name
+    except KeyError: uname = ""
+    try: gname = grp.getgrgid(gid).gr_name
+    except KeyError: gname = ""
+    return uname, gname
+
+def _fadvise(fd, advice):
+    """Вызывает os.posix_fadvise(fd, 0, 0, os.<advice>) для всего файла; где его нет (macOS), ничего не делает."""
+    if hasattr(os, 'posix_fadvise'):
+        try: os.posix_fadvise(fd, 0, 0, getattr(os, advice))
+        except OSError: pass
+
+def _is_up_to_date(src_stat, dst):
+    """Быстрая проверка, как у rsync без --checksum: файл назначения совпадает с источником по размеру и mtime."""
+    try:
+        dst_stat = os.stat(dst)
+    except FileNotFoundError:
+        return False
+    return dst_stat.st_size == src_stat.st_size and int(dst_stat.st_mtime) == int(src_stat.st_mtime)
+
+def copy_file(src, dst, progress_callback=None):
+    """
+    Копирует файл внутри процесса, без запуска rsync: данные идут через os.copy_file_range
+    (в ядре, на одной ФС - без копирования страниц), с откатом на sendfile/чтение блоками.
+    Переносятся права и время изменения; владелец и группа не переносятся, символические
+    ссылки разыменовываются. Если файл назначения уже совпадает с источником по размеру
+    и mtime, копирование пропускается и возвращается False. Если источник укоротился
+    во время копирования, выбрасывается OSError, а не остается обрезанный файл.
+    """
+    src_stat = os.stat(src)
+    if _is_up_to_date(src_stat, dst): return False
+    size = src_stat.st_size
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        _fadvise(src_fd, 'POSIX_FADV_SEQUENTIAL')
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            done = 0
+            try:
+                while done < size:
+                    copied = os.copy_file_range(src_fd, dst_fd, min(COPY_CHUNK_SIZE, size - done))
+                    if copied == 0: break
+                    done += copied
+                    if progress_callback: progress_callback(done, size)
+            except (AttributeError, OSError) as e:
+                # copy_file_range нет в этой ОС/ядре или он не работает между разными ФС
+                if isinstance(e, OSError) and e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP): raise
+                os.lseek(dst_fd, 0, os.SEEK_SET)
+                os.ftruncate(dst_fd, 0)
+                done = 0
+            if done < size:
+                # Остаток (или весь файл) - обычным способом с текущей позиции: copy_file_range
+                # на некоторых ФС (FUSE, CIFS, overlay) возвращает 0 раньше конца файла
+                _copy_file_data(src_fd, dst_fd, size, done)
+                if progress_callback: progress_callback(size, size)
+            os.fchmod(dst_fd, src_stat.st_mode & 0o7777)
+            os.utime(dst_fd, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+        finally:
+            os.close(dst_fd)
+        # Источник читается один раз - не вытесняем им из кэша страниц полезные данные
+        _fadvise(src_fd, 'POSIX_FADV_DONTNEED')
+    finally:
+        os.close(src_fd)
+    return True
+
+def copy_batch(source_files, dir_path, dest_dir, verify_checksum, progress_callback=None):
+    """
+    Копирует пакет файлов одного каталога в dest_dir. Ошибка одного файла не прерывает пакет:
+    возвращает (скопированные файлы, [(файл, ошибка), ...]). С verify_checksum пакет отдается
+    одному rsync --checksum, а если тот завершился ошибкой, файлы повторяются по одному -
+    rsync не сообщает, какие именно из них не удались.
+    """
+    total = len(source_files)
+    if verify_checksum:
+        rsync_cmd = ["rsync", "-a", "--checksum", "--from0", "--files-from=-", os.path.join(dir_path or '.', ''), dest_dir + os.sep]
+        file_list = b'\0'.join(os.fsencode(os.path.basename(name)) for name in source_files)
+        try:
+            subprocess.run(rsync_cmd, input=file_list, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            if progress_callback: progress_callback(total, total)
+            return list(source_files), []
+        except subprocess.CalledProcessError:
+            pass
+    copied, failed = [], []
+    for i, source_file in enumerate(source_files, 1):
+        dest_file = os.path.join(dest_dir, os.path.basename(source_file))
+        try:
+            if verify_checksum:
+                subprocess.run(["rsync", "-a", "--checksum", source_file, dest_file], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            else:
+                copy_file(source_file, dest_file)
+            copied.append(source_file)
+        except (OSError, subprocess.CalledProcessError) as e:
+            failed.append((source_file, e))
+        if progress_callback: progress_callback(i, total)
+    return copied, failed
+
+def _open_with_readahead(paths, depth=TAR_READAHEAD_DEPTH):
+    """
+    Открывает файлы с опережением на depth штук и просит ядро заранее подгрузить их
+    (POSIX_FADV_WILLNEED), чтобы чтение следующих кадров шло параллельно с записью текущего.
+    Отдает пары (path, fd); fd равен None, если файл не найден. Закрывать fd - задача вызывающего.
+    """
+    def _open(path):
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            return path, None
+        _fadvise(fd, 'POSIX_FADV_WILLNEED')
+        return path, fd
+
+    window = deque()
+    try:
+        for path in paths:
+            window.append(_open(path))
+            if len(window) > depth: yield window.popleft()
+        while window: yield window.popleft()
+    finally:
+        for _, fd in window:
+            if fd is not None: os.close(fd)
+
 def archive_sequence_to_destination(job, dest_tar_path, progress_callback=None):
+    """
+    Пишет tar-архив секвенции напрямую: заголовок каждого файла формируется через TarInfo,
+    а данные копируются ядром через os.sendfile без буферизации в Python.
+    """
     try:
-        os.makedirs(os.path.dirname(dest_tar_path), exist_ok=True)
+        ensure_dir(os.path.dirname(dest_tar_path))
         source_files = job.get('source_files', [])
         total_files = len(source_files)
-        with tarfile.open(dest_tar_path, "w") as tar:
-            for i, file_path in enumerate(source_files):
-                if os.path.exists(file_path):
-                    tar.add(file_path, arcname=os.path.basename(file_path))
-                else:
+        out_fd = os.open(dest_tar_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            # Выравнивание предыдущего файла пишется одним вызовом с заголовком следующего
+            written, padding = 0, b""
+            for i, (file_path, src_fd) in enumerate(_open_with_readahead(source_files)):
+                if src_fd is None:
                     log.warning(f"В секвенции не найден файл: {file_path}")
+                else:
+                    try:
+                        st = os.fstat(src_fd)
+                        tarinfo = tarfile.TarInfo(os.path.basename(file_path))
+                        # Целое mtime: дробное PAX-формат записывает отдельным расширенным
+                        # заголовком (+1 КБ на кадр). С целым расширенные заголовки пишутся
+                        # только для того, что не влезает в USTAR (длинные и не-ASCII имена, >8 ГБ)
+                        tarinfo.size, tarinfo.mtime = st.st_size, int(st.st_mtime)
+                        tarinfo.mode, tarinfo.uid, tarinfo.gid = st.st_mode & 0o7777, st.st_uid, st.st_gid
+                        tarinfo.uname, tarinfo.gname = _owner_names(st.st_uid, st.st_gid)
+                        header = tarinfo.tobuf(tarfile.PAX_FORMAT, tarfile.ENCODING, "surrogateescape")
+                        _write_all(out_fd, padding + header)
+                        _copy_file_data(src_fd, out_fd, st.st_size)
+                        padding = tarfile.NUL * (-st.st_size % tarfile.BLOCKSIZE)
+                        written += len(header) + st.st_size + len(padding)
+                        _fadvise(src_fd, 'POSIX_FADV_DONTNEED') # Кадр уже в архиве
+                    finally:
+                        os.close(src_fd)
                 if progress_callback:
                     progress_callback(i + 1, total_files)
+            # Конец архива: два нулевых блока и выравнивание до размера записи, как в tarfile
+            written += 2 * tarfile.BLOCKSIZE
+            _write_all(out_fd, padding + tarfile.NUL * (2 * tarfile.BLOCKSIZE + (-written % tarfile.RECORDSIZE)))
+        finally:
+            os.close(out_fd)
         return True
     except (IOError, OSError, tarfile.TarError) as e:
         log.error(f"Не удалось создать или записать архив {dest_tar_path}: {e}")
@@ -248,75 +604,158 @@ def scan_directory_and_plan_jobs(source_dir_path, config, processed_items_keys):
             for name in files:
                 all_file_paths.append(os.path.join(root, name))
 
-    dirs, all_files_map = defaultdict(list), {}
-    with Progress(console=console, transient=True) as progress:
+    dir_names, dir_sizes = defaultdict(list), defaultdict(lambda: array('q'))
+    with Progress(console=console, transient=True, refresh_per_second=4) as progress:
         task = progress.add_task("[green]Анализ файлов...", total=len(all_file_paths))
         for path in all_file_paths:
             try:
                 size = os.path.getsize(path)
-                path_obj = Path(path)
-                dirs[str(path_obj.parent)].append((path_obj.name, size))
-                all_files_map[str(path_obj)] = size
+                parent, sep, name = path.rpartition(os.sep)
+                parent = parent or sep
+                dir_names[parent].append(name); dir_sizes[parent].append(size)
             except FileNotFoundError:
                 log.warning(f"Файл не найден во время анализа: {path}")
             progress.update(task, advance=1)
 
-    sequences, sequence_files = find_sequences(dirs, config)
-    standalone_files = set(all_files_map.keys()) - sequence_files
+    sequences, sequence_files = find_sequences(dir_names, dir_sizes, config)
     archive_jobs = [job for job in sequences if job['key'] not in processed_items_keys]
-    copy_jobs = [{'type': 'file', 'key': f, 'size': all_files_map[f]} for f in standalone_files if f not in processed_items_keys]
-    archive_jobs.sort(key=lambda j: j.get('size', 0), reverse=True)
-    copy_jobs.sort(key=lambda j: j.get('size', 0), reverse=True)
-    stats = {"total_found": len(all_files_map), "mode": "dir"}
+    copy_jobs, total_found = plan_standalone_files(dir_names, dir_sizes, sequence_files, processed_items_keys)
+    archive_jobs.sort(key=itemgetter('size'), reverse=True)
+    copy_jobs.sort(key=itemgetter('size'), reverse=True)
+    stats = {"total_found": total_found, "mode": "dir"}
     return copy_jobs, archive_jobs, stats
 
 # Замените эту функцию целиком в copeer.py
+def _manifest_ranges(input_csv_path, parts):
+    """
+    Делит файл на parts диапазонов байт, границы которых выровнены по началу строки.
+    Граница может попасть внутрь поля в кавычках с переводом строки - это видно по нечетному
+    числу кавычек в диапазоне (см. _parse_manifest_range), и тогда файл разбирается целиком.
+    """
+    size = os.path.getsize(input_csv_path)
+    offsets = [0]
+    with open(input_csv_path, 'rb') as f:
+        for k in range(1, parts):
+            f.seek(size * k // parts)
+            f.readline()
+            if offsets[-1] < f.tell() < size: offsets.append(f.tell())
+    offsets.append(size)
+    return list(zip(offsets, offsets[1:]))
+
+def _parse_manifest_range(input_csv_path, start, end, source_root, progress_callback=None):
+    """
+    Разбирает строки манифеста из диапазона байт [start, end). Диапазон читается блоками
+    по MANIFEST_READ_SIZE, обрезанными по последнему переводу строки; строки блока отдаются
+    csv.reader вместе с переводами строк, поэтому поле в кавычках может продолжаться и в
+    следующей строке или блоке. Возвращает (dir_names, dir_sizes, строк всего, пропущено
+    директорий, некорректные строки с номерами относительно начала диапазона, четно ли
+    число кавычек в диапазоне - при нечетном граница диапазона попала внутрь поля).
+    """
+    # Структура массивов вместо списков кортежей (имя, размер): array('q') хранит размер в 8 байтах
+    dir_names, dir_sizes = defaultdict(list), defaultdict(lambda: array('q'))
+    lines_total, lines_ignored_dirs, malformed_lines, quote_count = 0, 0, [], 0
+    # Корень нормализуется один раз; для "чистых" относительных путей normpath в цикле не нужен
+    source_prefix = os.path.join(os.path.normpath(source_root), '') if source_root else None
+
+    with open(input_csv_path, 'rb') as f:
+        def blocks():
+            nonlocal quote_count
+            f.seek(start)
+            remaining, tail = end - start, b""
+            while remaining > 0 and (data := f.read(min(MANIFEST_READ_SIZE, remaining))):
+                remaining -= len(data)
+                quote_count += data.count(b'"')
+                data = tail + data
+                cut = data.rfind(b"\n") + 1 if remaining > 0 else len(data)
+                tail = data[cut:]
+                if progress_callback: progress_callback(end - start - remaining - len(tail))
+                # Переводы строк сохраняются (и нормализуются, как при чтении файла в текстовом режиме)
+                yield io.StringIO(data[:cut].decode('utf-8', 'ignore'), newline=None)
+        for i, row in enumerate(csv.reader(chain.from_iterable(blocks()), delimiter=';')):
+            lines_total += 1
+            if not row or len(row) < 5: malformed_lines.append((i + 1, str(row), "Недостаточно колонок")); continue
+            rel_path, file_type, size_str = row[0], row[1], row[4]
+            if 'directory' in file_type: lines_ignored_dirs += 1; continue
+            if 'file' not in file_type: malformed_lines.append((i + 1, str(row), f"Неизвестный тип: {file_type}")); continue
+            # Обычно размер - целое число; разбор с запятыми и экспонентой только для остальных.
+            # isascii нужен потому, что isdigit пропускает и символы вроде '²', на которых int() падает
+            size = int(size_str) if size_str.isascii() and size_str.isdigit() else parse_scientific_notation(size_str)
+            if source_prefix and rel_path and not rel_path.startswith(('/', '.')) and '/.' not in rel_path and '//' not in rel_path and not rel_path.endswith('/'):
+                absolute_source_path = source_prefix + rel_path
+            else:
+                absolute_source_path = os.path.normpath(os.path.join(source_root, rel_path) if source_root else rel_path)
+            # Каталог и имя отделяются строковой операцией, без разбора пути через Path
+            # У голого имени файла (без source_root) каталог - '', чтобы ключ совпал с исходным путем
+            parent, sep, name = absolute_source_path.rpartition(os.sep)
+            parent = parent or sep
+            dir_names[parent].append(name); dir_sizes[parent].append(size)
+    # defaultdict с lambda не сериализуется для передачи из процесса - возвращаем обычные dict
+    return dict(dir_names), dict(dir_sizes), lines_total, lines_ignored_dirs, malformed_lines, quote_count % 2 == 0
+
 def analyze_and_plan_jobs(input_csv_path, config, processed_items_keys):
     console.rule("[yellow]Шаг 1: Анализ и планирование[/]")
     console.print(f"Анализ файла: [bold cyan]{input_csv_path}[/bold cyan]")
-    dirs, all_files_from_csv = defaultdict(list), {}
+    dir_names, dir_sizes = defaultdict(list), defaultdict(lambda: array('q'))
     source_root = config.get('source_root')
     if source_root: console.print(f"Используется корень источника: [cyan]{source_root}[/cyan]")
-    lines_total, lines_ignored_dirs, malformed_lines = 0, 0, []
+    # Некорректные строки пишутся в файл; в памяти остаются только первые для отчета
+    lines_total, lines_ignored_dirs, malformed_count, malformed_lines = 0, 0, 0, []
 
     try:
-        with open(input_csv_path, 'r', encoding='utf-8', errors='ignore') as f: total_lines_for_progress = sum(1 for _ in f)
-        with Progress(console=console, transient=True) as progress:
-            task = progress.add_task("[green]Анализ CSV...", total=total_lines_for_progress)
-            with open(input_csv_path, 'r', encoding='utf-8', errors='ignore') as f:
-                reader = csv.reader(f, delimiter=';')
-                for i, row in enumerate(reader):
-                    progress.update(task, advance=1); lines_total += 1
-                    if not row or len(row) < 5: malformed_lines.append((i + 1, str(row), "Недостаточно колонок")); continue
-                    rel_path, file_type, size_str = row[0], row[1], row[4]
-                    if 'directory' in file_type: lines_ignored_dirs += 1; continue
-                    if 'file' not in file_type: malformed_lines.append((i + 1, str(row), f"Неизвестный тип: {file_type}")); continue
-                    size = parse_scientific_notation(size_str)
-                    absolute_source_path = os.path.normpath(os.path.join(source_root, rel_path) if source_root else rel_path)
-                    path_obj = Path(absolute_source_path)
-                    dirs[str(path_obj.parent)].append((path_obj.name, size))
-                    all_files_from_csv[absolute_source_path] = size
+        file_size = os.path.getsize(input_csv_path)
+        workers = os.cpu_count() or 1
+        with Progress(console=console, transient=True, refresh_per_second=4) as progress:
+            # Прогресс считается по прочитанным байтам, поэтому файл читается один раз
+            task = progress.add_task("[green]Анализ CSV...", total=file_size)
+            if file_size >= PARALLEL_CSV_MIN_BYTES and workers > 1:
+                # Большой манифест делится на диапазоны по границам строк и разбирается в нескольких процессах
+                ranges = _manifest_ranges(input_csv_path, workers)
+                parts = [None] * len(ranges)
+                with _process_pool(workers) as pool:
+                    futures = {pool.submit(_parse_manifest_range, input_csv_path, start, end, source_root): idx for idx, (start, end) in enumerate(ranges)}
+                    for future in as_completed(futures):
+                        idx = futures[future]
+                        parts[idx] = future.result()
+                        progress.advance(task, ranges[idx][1] - ranges[idx][0])
+                if not all(part[5] for part in parts):
+                    # Граница диапазона попала внутрь поля в кавычках - разбираем файл целиком
+                    progress.reset(task)
+                    parts = None
+            else:
+                parts = None
+            if parts is None:
+                parts = [_parse_manifest_range(input_csv_path, 0, file_size, source_root, lambda done: progress.update(task, completed=done))]
+
+            # Части сливаются в порядке следования в файле, чтобы порядок файлов и номера строк не менялись
+            with open(config['malformed_lines_file'], 'w', encoding='utf-8', buffering=1 << 16) as malformed_file:
+                for part_names, part_sizes, part_lines, part_dirs, part_malformed, _ in parts:
+                    for parent, names in part_names.items():
+                        dir_names[parent].extend(names); dir_sizes[parent].extend(part_sizes[parent])
+                    for num, row, reason in part_malformed:
+                        malformed_file.write(f"{lines_total + num}\t{reason}\t{row}\n")
+                        if malformed_count < MALFORMED_PREVIEW_LINES: malformed_lines.append((lines_total + num, row, reason))
+                        malformed_count += 1
+                    lines_total += part_lines; lines_ignored_dirs += part_dirs
     except Exception as e: console.print(f"[bold red]Критическая ошибка при чтении CSV: {e}[/bold red]"); sys.exit(1)
 
-    sequences, sequence_files = find_sequences(dirs, config)
-    standalone_files = set(all_files_from_csv.keys()) - sequence_files
-
+    sequences, sequence_files = find_sequences(dir_names, dir_sizes, config)
     archive_jobs_all = sequences
-    copy_jobs_all = [{'type': 'file', 'key': f, 'size': all_files_from_csv[f]} for f in standalone_files]
 
     # --- ИСПРАВЛЕННАЯ ЛОГИКА ---
     # Проверяем не виртуальное имя архива, а наличие первого исходного файла секвенции в state-файле.
     archive_jobs_to_process = [job for job in archive_jobs_all if job.get('source_files') and job['source_files'][0] not in processed_items_keys]
     # ---------------------------
 
-    copy_jobs_to_process = [job for job in copy_jobs_all if job['key'] not in processed_items_keys]
+    # Одиночные файлы собираются вторым проходом по каталогам, без общего словаря всех файлов
+    copy_jobs_to_process, total_found = plan_standalone_files(dir_names, dir_sizes, sequence_files, processed_items_keys)
 
-    archive_jobs_to_process.sort(key=lambda j: j.get('size', 0), reverse=True)
-    copy_jobs_to_process.sort(key=lambda j: j.get('size', 0), reverse=True)
+    archive_jobs_to_process.sort(key=itemgetter('size'), reverse=True)
+    copy_jobs_to_process.sort(key=itemgetter('size'), reverse=True)
 
     stats = {
         "mode": "csv", "lines_total": lines_total, "lines_ignored_dirs": lines_ignored_dirs,
-        "malformed_lines": malformed_lines, "total_found": len(all_files_from_csv)
+        "malformed_count": malformed_count, "malformed_lines": malformed_lines,
+        "malformed_lines_file": config['malformed_lines_file'], "total_found": total_found
     }
     return copy_jobs_to_process, archive_jobs_to_process, stats
 # Замените эту функцию целиком
@@ -330,7 +769,7 @@ def show_summary_and_confirm(copy_jobs, archive_jobs, stats):
         # --- Блок 1: Анализ исходного источника (CSV или директории) ---
         if stats.get("mode") == "csv":
             report_table.add_row("Всего строк в CSV:", f"{stats.get('lines_total', 0):,}")
-            malformed_count = len(stats.get('malformed_lines', []))
+            malformed_count = stats.get('malformed_count', 0)
             # Новая, более понятная формулировка
             report_table.add_row("  Пропущено (некорректный формат):", f"[{'red' if malformed_count > 0 else 'dim'}]{malformed_count:,}[/]")
             report_table.add_row("  Пропущено (записи с типом 'directory'):", f"[dim]{stats.get('lines_ignored_dirs', 0):,}[/dim]")
@@ -364,8 +803,9 @@ def show_summary_and_confirm(copy_jobs, archive_jobs, stats):
         if choice == 's': return True
         if choice == 'q': return False
         if choice == 'e' and malformed_lines:
-            console.print("\n[bold yellow]----- Список некорректных строк (первые 50) -----[/bold yellow]")
-            for num, line, reason in malformed_lines[:50]: console.print(f"[dim]Строка #{num} ({reason}):[/dim] {line}")
+            console.print(f"\n[bold yellow]----- Список некорректных строк (первые {len(malformed_lines)}) -----[/bold yellow]")
+            for num, line, reason in malformed_lines: console.print(f"[dim]Строка #{num} ({reason}):[/dim] {line}")
+            console.print(f"[dim]Полный список: {stats.get('malformed_lines_file')}[/dim]")
             console.input("\n[bold]Нажмите [green]Enter[/green] для возврата в меню...[/bold]")
             console.clear()
 # ИСПРАВЛЕНО: Явно принимает is_dry_run
@@ -377,7 +817,7 @@ def process_job_worker(worker_id, job, config, disk_manager, is_dry_run, is_debu
     как для отдельных файлов, так и для секвенций.
     """
     short_name = job.get('tar_filename') or os.path.basename(job['key'])
-    op_type_text = "[yellow]Архивация[/yellow]" if job['type'] == 'sequence' else "[cyan]Копирование[/cyan]"
+    op_type_text = {'sequence': "[yellow]Архивация[/yellow]", 'batch': "[cyan]Пакет[/cyan]"}.get(job['type'], "[cyan]Копирование[/cyan]")
     status_queue.put((worker_id, {"status": op_type_text, "job": job, "progress": 0, "disk_idx": None}))
 
     try:
@@ -391,14 +831,11 @@ def process_job_worker(worker_id, job, config, disk_manager, is_dry_run, is_debu
 
         status_queue.put((worker_id, {"disk_idx": disk_idx}))
 
-        source_root = config.get('source_root')
-        destination_root = config.get('destination_root', '/')
         absolute_source_key = job['key']
+        # Путь относительно источника посчитан при планировании (assign_rel_paths)
+        dest_path = os.path.normpath(os.path.join(dest_mount_point, config['_destination_rel'], job['rel_path']))
 
-        rel_path = os.path.relpath(absolute_source_key, source_root) if source_root and absolute_source_key.startswith(source_root) else absolute_source_key.lstrip(os.path.sep)
-        dest_path = os.path.normpath(os.path.join(dest_mount_point, destination_root.lstrip(os.path.sep), rel_path))
-
-        source_keys_to_log = []
+        source_keys_to_log, job_size = [], job['size']
 
         if job['type'] == 'sequence':
             # Для секвенций в лог состояния пойдут все исходные файлы
@@ -411,30 +848,62 @@ def process_job_worker(worker_id, job, config, disk_manager, is_dry_run, is_debu
                 for i in range(total_files):
                     time.sleep(0.005)
                     if progress_callback: progress_callback(i + 1, total_files)
+        elif job['type'] == 'batch':
+            # Пакет мелких файлов одного каталога: ключ задания - каталог, dest_path - каталог назначения
+            source_keys_to_log = job['source_files']
+            if not is_dry_run:
+                ensure_dir(dest_path)
+                if config.get('verify_checksum'): status_queue.put((worker_id, {"status": "[blue]rsync...[/blue]"}))
+                last_percent = [0]
+                def report_batch(done, total):
+                    if (percent := done * 100 // total) != last_percent[0]:
+                        last_percent[0] = percent
+                        status_queue.put((worker_id, {"progress": percent}))
+                # Файлы пакета независимы: в лог ошибок идут только неудавшиеся,
+                # а скопированные попадают в состояние и маппинг как обычно
+                source_keys_to_log, failed = copy_batch(job['source_files'], job['dir_path'], dest_path, config.get('verify_checksum'), report_batch)
+                if failed:
+                    log_file_errors(config, failed)
+                    if not source_keys_to_log:
+                        status_queue.put((worker_id, {"status": "[bold red]Ошибка[/bold red]", "progress": 0}))
+                        return (None, 0, None, None)
+                    file_sizes = dict(zip(job['source_files'], job['file_sizes']))
+                    job_size = sum(file_sizes[key] for key in source_keys_to_log)
+            else: # Dry-run симуляция
+                time.sleep(0.7 if is_debug_mode else 0.2)
         else:  # 'file'
             # Для обычного файла - только его ключ
             source_keys_to_log = [absolute_source_key]
             if not is_dry_run:
-                if not os.path.exists(absolute_source_key): raise FileNotFoundError(f"Исходный файл не найден: {absolute_source_key}")
-                os.makedirs(os.path.dirname(dest_path), exist_ok=True)
-
-                # ... (блок rsync остается без изменений)
-                rsync_cmd = ["rsync", "-a", "--no-i-r", "--progress", absolute_source_key, dest_path]
-                status_queue.put((worker_id, {"status": "[blue]rsync...[/blue]"}))
-                process = subprocess.Popen(rsync_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding='utf-8', errors='ignore')
-                progress_re = re.compile(r'\s+(\d+)%')
-                line_buffer = ""
-                for char in iter(lambda: process.stdout.read(1), ''):
-                    if char in ['\r', '\n']:
-                        if match := progress_re.search(line_buffer):
+                ensure_dir(os.path.dirname(dest_path))
+
+                if not config.get('verify_checksum'):
+                    # Копирование в процессе (copy_file_range); при докопировании
+                    # файл, совпадающий по размеру и mtime, пропускается, как у rsync
+                    status_queue.put((worker_id, {"status": "[blue]Копирование...[/blue]"}))
+                    last_percent = [0]
+                    def report_copy(done, total):
+                        if (percent := done * 100 // total) != last_percent[0]:
+                            last_percent[0] = percent
+                            status_queue.put((worker_id, {"progress": percent}))
+                    copy_file(absolute_source_key, dest_path, report_copy)
+                else:
+                    # Сверка по содержимому: rsync --checksum читает оба файла целиком
+                    rsync_cmd = ["rsync", "-a", "--checksum", "--no-i-r", "--progress", absolute_source_key, dest_path]
+                    status_queue.put((worker_id, {"status": "[blue]rsync...[/blue]"}))
+                    process = subprocess.Popen(rsync_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                    # Читаем вывод блоками (блокирующий os.read отпускает GIL) и берем процент
+                    # из последней завершенной строки блока; строки rsync заканчиваются на \r или \n
+                    stdout_fd, pending = process.stdout.fileno(), b""
+                    while chunk := os.read(stdout_fd, RSYNC_READ_SIZE):
+                        lines, _, pending = (pending + chunk.replace(b"\n", b"\r")).rpartition(b"\r")
+                        if lines and (match := RSYNC_PROGRESS_RE.search(lines.rpartition(b"\r")[2])):
                             status_queue.put((worker_id, {"progress": int(match.group(1))}))
-                        line_buffer = ""
-                    else:
-                        line_buffer += char
-                process.stdout.close()
-                return_code = process.wait()
-                if return_code != 0 and "died with <Signals.SIGINT: 2>" not in (error_output := process.stderr.read()) and return_code != -2:
-                    raise subprocess.CalledProcessError(return_code, rsync_cmd, stderr=error_output)
+                    process.stdout.close()
+                    return_code = process.wait()
+                    error_output = process.stderr.read().decode('utf-8', 'ignore')
+                    if return_code != 0 and "died with <Signals.SIGINT: 2>" not in error_output and return_code != -2:
+                        raise subprocess.CalledProcessError(return_code, rsync_cmd, stderr=error_output)
 
             else: # Dry-run симуляция
                 steps = 5 if is_debug_mode else 3
@@ -448,34 +917,152 @@ def process_job_worker(worker_id, job, config, disk_manager, is_dry_run, is_debu
         status_queue.put((worker_id, {"status": final_status, "progress": 100}))
 
         # Возвращаем тип, размер и КЛЮЧИ ИСХОДНЫХ ФАЙЛОВ для записи в лог состояния
-        return (job['type'], job['size'], source_keys_to_log, dest_path)
+        return (job['type'], job_size, source_keys_to_log, dest_path)
 
     except Exception as e:
         if not isinstance(e, KeyboardInterrupt):
             status_queue.put((worker_id, {"status": "[bold red]Ошибка[/bold red]", "progress": 0}))
 
             # --- ТИХОЕ ЛОГИРОВАНИЕ ОШИБОК БЕЗ ВЫВОДА В КОНСОЛЬ ---
-            if job['type'] == 'sequence':
-                # Если упала секвенция, логируем все её ИСХОДНЫЕ файлы
-                error_message = f"Sequence processing failed for '{job['key']}': {e}"
-                with file_lock:
-                    with open(config['error_log_file'], "a", encoding='utf-8') as f:
-                        for source_file in job.get('source_files', []):
-                             f.write(f"{time.asctime()};{source_file};{error_message}\n")
+            if job['type'] in ('sequence', 'batch'):
+                # Если упала секвенция или пакет целиком, логируем все их ИСХОДНЫЕ файлы
+                error_message = f"Sequence processing failed for '{job['key']}': {e}" if job['type'] == 'sequence' else str(e)
+                log_file_errors(config, zip(job.get('source_files', []), repeat(error_message)))
             else:
                 # Если упал обычный файл, логируем его ключ, как и раньше
-                with file_lock:
-                    with open(config['error_log_file'], "a", encoding='utf-8') as f:
-                        f.write(f"{time.asctime()};{job['key']};{e}\n")
+                log_file_errors(config, [(job['key'], e)])
 
         return (None, 0, None, None)
 
+def assign_rel_paths(jobs, source_root):
+    """
+    Записывает в каждое задание путь его ключа относительно корня источника ('rel_path'),
+    чтобы при выполнении оставалось лишь приклеить его к диску и destination_root.
+    """
+    source_prefix = os.path.join(os.path.normpath(source_root), '') if source_root else None
+    for job in jobs:
+        key = job['key']
+        if source_prefix and key.startswith(source_prefix): job['rel_path'] = key[len(source_prefix):]
+        elif source_prefix and key + os.sep == source_prefix: job['rel_path'] = ''
+        else: job['rel_path'] = key.lstrip(os.sep)
+
+def batch_file_jobs(copy_jobs, batch_size, max_file_size):
+    """
+    Объединяет мелкие (меньше max_file_size) файлы одного каталога в пакеты по batch_size
+    штук: пакет обрабатывается одним заданием, без запуска rsync на каждый файл.
+    Крупные файлы остаются отдельными заданиями.
+    """
+    jobs, small_by_dir = [], defaultdict(list)
+    for job in copy_jobs:
+        if job['size'] < max_file_size:
+            parent, sep, _ = job['key'].rpartition(os.sep)
+            small_by_dir[parent or sep].append(job)
+        else:
+            jobs.append(job)
+    for dir_path, file_jobs in small_by_dir.items():
+        for i in range(0, len(file_jobs), batch_size):
+            chunk = file_jobs[i:i + batch_size]
+            if len(chunk) == 1:
+                jobs.append(chunk[0])
+                continue
+            jobs.append({'type': 'batch', 'key': dir_path, 'dir_path': dir_path, 'source_files': [j['key'] for j in chunk], 'file_sizes': [j['size'] for j in chunk], 'size': sum(j['size'] for j in chunk)})
+    jobs.sort(key=itemgetter('size'), reverse=True)
+    return jobs
+
+def _steal_job(shards, own_index):
+    """Забирает задание из головы очереди случайно выбранного соседа. None - все очереди пусты."""
+    count = len(shards)
+    start = random.randrange(count)
+    for offset in range(count):
+        victim = (start + offset) % count
+        if victim == own_index: continue
+        try: return shards[victim].popleft()
+        except IndexError: continue
+    return None
+
+def start_work_stealing_pool(jobs, num_workers, handle_job, results, stop_event):
+    """
+    Запускает num_workers потоков с собственными очередями (deque) вместо общей очереди
+    ThreadPoolExecutor. Задания (отсортированные по убыванию размера) раскладываются
+    по правилу LPT: каждое следующее идет в очередь с наименьшим суммарным объемом,
+    поэтому объем работы у потоков выравнивается. Поток берет задания с хвоста своей
+    очереди, каталог за каталогом, а опустев, забирает задания из головы чужой очереди.
+    Операции deque атомарны, блокировки не нужны.
+    Результаты handle_job(worker_id, job) складываются в deque results.
+    """
+    shards = [deque() for _ in range(num_workers)]
+    loads = [(0, i) for i in range(num_workers)] # Куча (объем очереди, индекс очереди)
+    for job in jobs:
+        load, i = loads[0]
+        shards[i].appendleft(job)
+        heapq.heapreplace(loads, (load + job['size'], i))
+    # Объем у потоков выровнен раскладкой, порядок внутри очереди на него не влияет. Поэтому
+    # поток проходит свои задания по каталогам (в каталоге - от крупных к мелким): на HDD
+    # соседние задания читают и пишут рядом, а кэш каталогов и inode не перебирается.
+    # Хвост очереди (pop) - первый по порядку каталог
+    for i, shard in enumerate(shards):
+        shards[i] = deque(sorted(shard, key=lambda job: (job.get('dir_path') or os.path.dirname(job['key']), -job['size']), reverse=True))
+
+    def worker(index):
+        own = shards[index]
+        while not stop_event.is_set():
+            try: job = own.pop()
+            except IndexError:
+                job = _steal_job(shards, index)
+                if job is None: return
+            results.append(handle_job(index + 1, job))
+
+    threads = [Thread(target=worker, args=(i,), name=f"worker-{i + 1}", daemon=True) for i in range(num_workers)]
+    for thread in threads: thread.start()
+    return threads
+
+def write_dry_run_mapping(jobs, config, disk_manager):
+    """
+    Dry-run без дашборда и имитации копирования: пути назначения считаются так же,
+    как в process_job_worker (с выбором диска по стратегии), и весь отчет пишется
+    в dry_run_mapping_file одним вызовом write_log.
+    """
+    keys, dest_paths = [], []
+    for job in jobs:
+        try:
+            dest_mount_point = disk_manager.get_current_destination(job['size'])
+        except RuntimeError as e:
+            console.print(f"[bold red]Dry-run остановлен на {job['key']}: {e}[/bold red]")
+            break
+        dest_path = os.path.normpath(os.path.join(dest_mount_point, config['_destination_rel'], job['rel_path']))
+        if job['type'] == 'file':
+            keys.append(job['key']); dest_paths.append(dest_path)
+        elif job['type'] == 'batch':
+            keys.extend(job['source_files'])
+            dest_paths.extend(os.path.join(dest_path, os.path.basename(key)) for key in job['source_files'])
+        else: # Все кадры секвенции попадают в один архив
+            keys.extend(job['source_files'])
+            dest_paths.extend(repeat(dest_path, len(job['source_files'])))
+    _, mapping_fd = open_log_files(config, True)
+    try:
+        write_log(None, mapping_fd, keys, dest_paths, True)
+    finally:
+        os.close(mapping_fd)
+    console.print(f"[green]Dry-run: в {config['dry_run_mapping_file']} записано {len(keys):,} путей.[/green]")
+
 def make_layout() -> Layout:
     layout = Layout(name="root")
     layout.split_column(Layout(name="top", size=19), Layout(name="middle"), Layout(name="bottom", size=3))
     layout["top"].split_row(Layout(name="summary"), Layout(name="disks"))
     return layout
 
+class SnapshotPanel:
+    """
+    Панель, которая строится заново при каждой перерисовке Live: рабочие потоки и главный
+    цикл только меняют счетчики и worker_stats, а таблицы собираются из их текущего
+    снимка с частотой refresh_per_second, независимо от числа завершенных заданий.
+    """
+    def __init__(self, build):
+        self.build = build
+
+    def __rich__(self):
+        return self.build()
+
 def generate_summary_panel(plan, completed) -> Panel:
     table = Table(box=None, expand=True)
     table.add_column("Тип задания", style="cyan", no_wrap=True)
@@ -508,17 +1095,18 @@ def generate_disks_panel(disk_manager: DiskManager, config) -> Panel:
     table.add_column("%", style="bold", justify="right")
     for mount, percent in disk_manager.get_all_disks_status():
         color = "green" if percent < config['threshold'] else "red"
-        try:
-            st = os.statvfs(mount); total = st.f_blocks * st.f_frsize; used = total - (st.f_bfree * st.f_frsize)
-            size_str = f"{decimal(used)} / {decimal(total)}"
-        except FileNotFoundError: size_str = "[red]Н/Д[/red]"
-        bar = Progress(BarColumn(bar_width=None, style=color, complete_style=color))
-        bar.add_task("d", total=100, completed=percent)
+        disk_size = disk_manager.get_disk_size(mount)
+        size_str = f"{decimal(disk_size[0])} / {decimal(disk_size[1])}" if disk_size else "[red]Н/Д[/red]"
+        bar = ProgressBar(total=100, completed=percent, style=color, complete_style=color)
         is_active = " (*)" if mount == disk_manager.active_disk else ""
         table.add_row(f"[bold]{mount}{is_active}[/bold]", size_str, bar, f"{percent:.1f}%")
     return Panel(table, title="📦 Диски", border_style="blue")
 
 # Замените эту функцию целиком
+def reset_worker_stats(threads):
+    """Заполняет worker_stats записями "Ожидание" по одной на поток (worker_id от 1 до threads)."""
+    worker_stats[:] = [{"status": "[grey50]Ожидание...[/grey50]", "job": None, "progress": 0} for _ in range(threads)]
+
 def generate_workers_panel(threads) -> Panel:
     table = Table(box=None, expand=True, show_header=True)
     table.add_column("Размер", justify="right", style="cyan", width=12)
@@ -526,11 +1114,11 @@ def generate_workers_panel(threads) -> Panel:
     table.add_column("Статус", justify="left", style="white", width=20) # Немного увеличим ширину
     table.add_column("Прогресс", justify="left", ratio=2)
 
-    for worker_id in range(1, threads + 1):
-        stats = worker_stats.get(worker_id)
-        if stats and (job := stats.get("job")):
+    for stats in worker_stats:
+        if job := stats.get("job"):
             size_str = decimal(job['size'])
             short_name = job.get('tar_filename') or os.path.basename(job['key'])
+            if job['type'] == 'batch': short_name = f"{short_name}/ ({len(job['source_files'])} файлов)"
             status_text = stats.get("status", "")
             progress_val = stats.get("progress", 0)
 
@@ -544,13 +1132,16 @@ def generate_workers_panel(threads) -> Panel:
 
             progress_widget = ""
             if isinstance(progress_val, (int, float)) and progress_val > 0:
-                progress_widget = Progress(BarColumn(bar_width=None), TaskProgressColumn(), expand=True)
-                progress_widget.add_task("p", total=100, completed=progress_val)
+                # Голая полоса вместо Progress: панель строится на каждой перерисовке,
+                # а Progress тянет за собой Live, задачи и замеры скорости
+                progress_widget = Table.grid(expand=True)
+                progress_widget.add_column(ratio=1); progress_widget.add_column(justify="right", width=5)
+                progress_widget.add_row(ProgressBar(total=100, completed=progress_val), f"{progress_val:.0f}%")
             elif progress_val:
                 progress_widget = str(progress_val)
 
             table.add_row(size_str, short_name, status_with_disk, progress_widget)
-        elif stats:
+        else:
             table.add_row("[dim]---[/dim]", f"[grey50]{stats.get('status', 'Ожидание...')}[/grey50]", "", "")
 
     return Panel(table, title=f"👷 Потоки ({threads})", border_style="green")
@@ -578,16 +1169,25 @@ def main(args):
                 csv.writer(f).writerow(["source_path", "destination_path"])
         except IOError as e: console.print(f"[bold red]Не удалось создать файл отчета: {e}[/bold red]")
 
-    processed_items_keys = set()
-    load_previous_state(config['state_file'], processed_items_keys)
-
-    if args.input_file:
-        copy_jobs, archive_jobs, stats = analyze_and_plan_jobs(args.input_file, config, processed_items_keys)
-    elif args.source_dir:
-        config['source_root'] = os.path.abspath(args.source_dir)
-        copy_jobs, archive_jobs, stats = scan_directory_and_plan_jobs(args.source_dir, config, processed_items_keys)
-    else:
-        console.print("[bold red]Ошибка: Не указан источник данных (--input-file или --source-dir).[/bold red]"); sys.exit(1)
+    # Загрузка состояния и планирование создают миллионы долгоживущих объектов без циклов
+    # (строки путей, кортежи, словари заданий). Циклический GC на этом этапе лишь раз за разом
+    # обходит растущую кучу, поэтому он отключается, а после планирования объекты замораживаются,
+    # чтобы сборки во время копирования их не сканировали.
+    gc.disable()
+    try:
+        processed_items_keys = set()
+        load_previous_state(config['state_file'], processed_items_keys)
+
+        if args.input_file:
+            copy_jobs, archive_jobs, stats = analyze_and_plan_jobs(args.input_file, config, processed_items_keys)
+        elif args.source_dir:
+            config['source_root'] = os.path.abspath(args.source_dir)
+            copy_jobs, archive_jobs, stats = scan_directory_and_plan_jobs(args.source_dir, config, processed_items_keys)
+        else:
+            console.print("[bold red]Ошибка: Не указан источник данных (--input-file или --source-dir).[/bold red]"); sys.exit(1)
+    finally:
+        gc.enable()
+    gc.freeze()
 
     if not copy_jobs and not archive_jobs:
         console.print("[green]Все задания уже выполнены. Завершение работы.[/green]"); return
@@ -613,8 +1213,7 @@ def main(args):
     )
     if not is_dry_run and not disk_manager.active_disk: return
 
-    for i in range(1, config['threads'] + 1):
-        worker_stats[i] = {"status": "[grey50]Ожидание...[/grey50]", "job": None, "progress": 0}
+    reset_worker_stats(config['threads'])
 
     layout = make_layout()
     completed_stats = {"sequence": {"count": 0, "size": 0, "errors": 0}, "files": {"count": 0, "size": 0, "errors": 0}}
@@ -622,97 +1221,114 @@ def main(args):
         "sequences": {"count": len(archive_jobs), "size": sum(j.get('size', 0) for j in archive_jobs)},
         "files": {"count": len(copy_jobs), "size": sum(j.get('size', 0) for j in copy_jobs)}
     }
+    copy_jobs = batch_file_jobs(copy_jobs, config['rsync_batch_size'], config['rsync_batch_max_file_size'])
+    assign_rel_paths(copy_jobs, config.get('source_root'))
+    assign_rel_paths(archive_jobs, config.get('source_root'))
+    config['_destination_rel'] = os.path.normpath(config.get('destination_root', '/')).lstrip(os.sep)
 
-    layout["summary"].update(generate_summary_panel(plan_summary, completed_stats))
-    layout["disks"].update(generate_disks_panel(disk_manager, config))
-    layout["middle"].update(generate_workers_panel(config['threads']))
+    if is_dry_run and not is_debug_mode:
+        # Наглядная симуляция в дашборде нужна только в режиме отладки
+        write_dry_run_mapping(copy_jobs + archive_jobs, config, disk_manager)
+        return
 
-    executor = None
+    layout["summary"].update(SnapshotPanel(lambda: generate_summary_panel(plan_summary, completed_stats)))
+    layout["disks"].update(SnapshotPanel(lambda: generate_disks_panel(disk_manager, config)))
+    layout["middle"].update(SnapshotPanel(lambda: generate_workers_panel(len(worker_stats))))
+
+    state_fd, mapping_fd = open_log_files(config, is_dry_run)
+
+    stop_workers, worker_threads = Event(), []
     try:
-        with Live(layout, screen=True, redirect_stderr=False, vertical_overflow="visible", refresh_per_second=10) as live:
-            with ThreadPoolExecutor(max_workers=config['threads']) as executor:
-                if copy_jobs:
-                    progress_bar = Progress(TextColumn("[bold blue]Копирование:[/bold blue]"), BarColumn(), TaskProgressColumn(), "•", TransferSpeedColumn())
-                    main_task = progress_bar.add_task("copying", total=sum(j.get('size', 0) for j in copy_jobs))
-                    layout["bottom"].update(Panel(progress_bar, title="🚀 Фаза 1: Копирование", border_style="magenta", height=3))
-
-                    worker_id_queue, id_lock = list(range(1, config['threads'] + 1)), Lock()
-                    def get_worker_id():
-                        with id_lock: return worker_id_queue.pop(0) if worker_id_queue else None
-                    def release_worker_id(worker_id):
-                        if worker_id is not None:
-                            with id_lock:
-                                worker_id_queue.append(worker_id)
-
-                    def job_wrapper(job):
-                        worker_id = None
-                        while worker_id is None:
-                            worker_id = get_worker_id()
-                            if worker_id is None: time.sleep(0.1)
-                        try:
-                            # КЛЮЧЕВОЕ ИСПРАВЛЕНИЕ: Явная передача флагов
-                            return process_job_worker(worker_id, job, config, disk_manager, is_dry_run, is_debug_mode)
-                        finally: release_worker_id(worker_id)
-
-                    active_futures = {executor.submit(job_wrapper, job) for job in copy_jobs}
-
-                    while active_futures:
-                        while not status_queue.empty():
-                            worker_id, update_data = status_queue.get(); worker_stats[worker_id].update(update_data)
-
-                        done_futures = {f for f in active_futures if f.done()}
-                        for future in done_futures:
-                            job_type, size, keys, path = future.result()
-                            if job_type:
-                                for key in keys: write_log(config['state_file'], config['mapping_file'], key, path, is_dry_run)
-                                completed_stats['files']['count'] += 1; completed_stats['files']['size'] += size
-                                progress_bar.update(main_task, advance=size)
-                            else:
-                                # Увеличиваем счетчик ошибок
-                                completed_stats['files']['errors'] += 1
-                        active_futures -= done_futures
-
-                        layout["summary"].update(generate_summary_panel(plan_summary, completed_stats))
-                        layout["disks"].update(generate_disks_panel(disk_manager, config))
-                        layout["middle"].update(generate_workers_panel(config['threads']))
-                        time.sleep(0.1)
-
-                if archive_jobs:
-                    for i in range(1, config['threads'] + 1):
-                        worker_stats[i] = {"status": "[grey50]Ожидание...[/grey50]", "job": None, "progress": 0}
-
-                    progress_bar = Progress(TextColumn("[bold yellow]Архивация:[/bold yellow]"), BarColumn(), TaskProgressColumn(), "•", TimeRemainingColumn())
-                    main_task = progress_bar.add_task("archiving", total=len(archive_jobs))
-                    layout["bottom"].update(Panel(progress_bar, title="📦 Фаза 2: Архивация (1 поток)", border_style="yellow", height=3))
-
-                    for job in archive_jobs:
-                        def progress_callback(current, total):
-                            status_queue.put((1, {"progress": (current / total) * 100}))
-
-                        future = executor.submit(process_job_worker, 1, job, config, disk_manager, is_dry_run, is_debug_mode, progress_callback)
-
-                        while not future.done():
-                            while not status_queue.empty():
-                                worker_id, update_data = status_queue.get(); worker_stats[worker_id].update(update_data)
-                            layout["summary"].update(generate_summary_panel(plan_summary, completed_stats))
-                            layout["disks"].update(generate_disks_panel(disk_manager, config))
-                            layout["middle"].update(generate_workers_panel(config['threads']))
-                            time.sleep(0.1)
-
-                        job_type, size, keys, path = future.result()
+        with Live(layout, screen=True, redirect_stderr=False, vertical_overflow="visible", refresh_per_second=round(1 / PANEL_REFRESH_INTERVAL)):
+            if copy_jobs:
+                progress_bar = Progress(TextColumn("[bold blue]Копирование:[/bold blue]"), BarColumn(), TaskProgressColumn(), "•", TransferSpeedColumn())
+                main_task = progress_bar.add_task("copying", total=sum(j.get('size', 0) for j in copy_jobs))
+                layout["bottom"].update(Panel(progress_bar, title="🚀 Фаза 1: Копирование", border_style="magenta", height=3))
+
+                def handle_copy_job(worker_id, job):
+                    # Для статистики нужно число файлов в задании: пакет содержит несколько
+                    files_in_job = len(job['source_files']) if job['type'] == 'batch' else 1
+                    # КЛЮЧЕВОЕ ИСПРАВЛЕНИЕ: Явная передача флагов
+                    return files_in_job, process_job_worker(worker_id, job, config, disk_manager, is_dry_run, is_debug_mode)
+
+                copy_results = deque()
+                worker_threads = start_work_stealing_pool(copy_jobs, config['threads'], handle_copy_job, copy_results, stop_workers)
+
+                while True:
+                    # Живость проверяется до сбора результатов: поток может положить последний
+                    # результат и завершиться между проверками, и тогда тот остался бы несобранным
+                    workers_alive = any(t.is_alive() for t in worker_threads)
+                    while not status_queue.empty():
+                        worker_id, update_data = status_queue.get(); worker_stats[worker_id - 1].update(update_data)
+
+                    # Все завершенные за тик задания пишутся в лог одной записью на файл
+                    done_keys, done_dests = [], []
+                    while copy_results:
+                        files_in_job, (job_type, size, keys, path) = copy_results.popleft()
+                        if job_type:
+                            done_keys.extend(keys)
+                            # Для пакета path - каталог назначения, файлы лежат в нем под своими именами
+                            if job_type == 'batch': done_dests.extend(os.path.join(path, os.path.basename(key)) for key in keys)
+                            else: done_dests.extend(repeat(path, len(keys)))
+                            # Из пакета могли скопироваться не все файлы - остальные уже в errors.log
+                            completed_stats['files']['count'] += len(keys); completed_stats['files']['size'] += size
+                            completed_stats['files']['errors'] += files_in_job - len(keys)
+                            progress_bar.update(main_task, advance=size)
+                        else:
+                            # Увеличиваем счетчик ошибок
+                            completed_stats['files']['errors'] += files_in_job
+                    if done_keys: write_log(state_fd, mapping_fd, done_keys, done_dests, is_dry_run)
+
+                    if not workers_alive: break
+                    time.sleep(0.1)
+
+            if archive_jobs:
+                # Секвенции независимы и пишутся в разные архивы - собираем их параллельно
+                archive_threads = config.get('archive_threads') or max(2, config['threads'] // 2)
+                # Статусы фазы 1, оставшиеся в очереди, относятся к старому набору потоков
+                for thread in worker_threads: thread.join()
+                while not status_queue.empty(): status_queue.get()
+                reset_worker_stats(archive_threads)
+
+                progress_bar = Progress(TextColumn("[bold yellow]Архивация:[/bold yellow]"), BarColumn(), TaskProgressColumn(), "•", TimeRemainingColumn())
+                main_task = progress_bar.add_task("archiving", total=len(archive_jobs))
+                layout["bottom"].update(Panel(progress_bar, title=f"📦 Фаза 2: Архивация ({archive_threads} потоков)", border_style="yellow", height=3))
+
+                def handle_archive_job(worker_id, job):
+                    def progress_callback(current, total):
+                        status_queue.put((worker_id, {"progress": (current / total) * 100}))
+                    return process_job_worker(worker_id, job, config, disk_manager, is_dry_run, is_debug_mode, progress_callback)
+
+                archive_results = deque()
+                worker_threads = start_work_stealing_pool(archive_jobs, archive_threads, handle_archive_job, archive_results, stop_workers)
+
+                while True:
+                    workers_alive = any(t.is_alive() for t in worker_threads)
+                    while not status_queue.empty():
+                        worker_id, update_data = status_queue.get(); worker_stats[worker_id - 1].update(update_data)
+
+                    done_keys, done_dests = [], []
+                    while archive_results:
+                        job_type, size, keys, path = archive_results.popleft()
                         if job_type:
-                            for key in keys: write_log(config['state_file'], config['mapping_file'], key, path, is_dry_run)
+                            done_keys.extend(keys); done_dests.extend(repeat(path, len(keys)))
                             completed_stats['sequence']['count'] += 1; completed_stats['sequence']['size'] += size
                         else:
                             # Увеличиваем счетчик ошибок
                             completed_stats['sequence']['errors'] += 1
                         progress_bar.update(main_task, advance=1)
+                    if done_keys: write_log(state_fd, mapping_fd, done_keys, done_dests, is_dry_run)
+
+                    if not workers_alive: break
+                    time.sleep(0.1)
 
     except KeyboardInterrupt:
         console.print("\n[bold yellow]Прерывание... Ожидание завершения потоков...[/bold yellow]")
     finally:
-        if 'executor' in locals() and executor:
-            executor.shutdown(wait=True, cancel_futures=True)
+        stop_workers.set()
+        for thread in worker_threads: thread.join()
+        for fd in (state_fd, mapping_fd):
+            if fd is not None: os.close(fd)
         console.print("\n[bold green]Выход.[/bold green]")
 
 if __name__ == "__main__":
@@ -11,8 +11,10 @@ v7.0:
 """
 import csv
 import os
+from functools import lru_cache
 from pathlib import Path
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 # Сторонние библиотеки
 from rich.console import Console
@@ -26,6 +28,8 @@ import questionary
 from prompt_toolkit.completion import PathCompleter
 
 console = Console()
+WRITE_BUFFER_SIZE = 1 << 20 # Буфер записи отчетов: миллионы коротких строк уходят на диск блоками по 1 МБ
+VERIFY_THREADS = 16 # Потоки проверки каталогов назначения: чтение каталогов упирается в диск/сеть, а не в GIL
 path_completer = PathCompleter(expanduser=True, only_directories=False)
 dir_completer = PathCompleter(expanduser=True, only_directories=True)
 
@@ -39,6 +43,8 @@ def parse_scientific_notation(size_str: str) -> int:
         return int(cleaned_str)
     except (ValueError, TypeError): return 0
 
+# Каталогов в маппинге на порядки меньше, чем файлов: результат кэшируется по пути каталога
+@lru_cache(maxsize=None)
 def normalize_directory_path(path_str: str) -> str:
     p = Path(path_str)
     parts = p.parts
@@ -48,6 +54,12 @@ def normalize_directory_path(path_str: str) -> str:
     fallback_parts = parts[-4:]
     return str(Path(*fallback_parts))
 
+@lru_cache(maxsize=None)
+def _destination_disk(dir_path: str) -> str:
+    """Диск назначения (/mnt/<диск>) по каталогу файла."""
+    parts = Path(dir_path).parts
+    return f"/{parts[1]}/{parts[2]}" if len(parts) > 2 and parts[1] == 'mnt' else "unknown"
+
 def find_source_root(state_file_paths, source_list_paths):
     if not state_file_paths or not source_list_paths:
         return None
@@ -66,6 +78,21 @@ def find_source_root(state_file_paths, source_list_paths):
 
 # --- Основные функции команд ---
 
+def _find_missing_in_dir(parent, paths):
+    """
+    Проверяет наличие файлов одного каталога по одному его чтению.
+    paths - {имя: полный путь}; возвращает (paths, список отсутствующих полных путей).
+    """
+    try:
+        with os.scandir(parent) as entries:
+            missing = paths.keys() - {entry.name for entry in entries}
+    except (FileNotFoundError, NotADirectoryError):
+        missing = paths.keys()
+    except OSError:
+        # Каталог нельзя прочитать (например, нет права r) - проверяем файлы по одному
+        missing = [name for name, path in paths.items() if not os.path.exists(path)]
+    return paths, [paths[name] for name in missing]
+
 def _run_verification(stats_data):
     """Вспомогательная функция для запуска и отображения верификации."""
     console.rule("[bold blue]Верификация файлов[/bold blue]")
@@ -76,13 +103,19 @@ def _run_verification(stats_data):
     if not all_dest_paths:
         console.print("[yellow]Нет файлов для верификации.[/yellow]")
         return
+    # Вместо stat на каждый путь - одно чтение каталога на каждую родительскую директорию
+    # (все кадры секвенции к тому же ссылаются на один и тот же архив); каталоги читаются
+    # в VERIFY_THREADS потоках - os.scandir отпускает GIL на время системных вызовов
+    paths_by_dir = defaultdict(dict)
+    for path in all_dest_paths:
+        parent, sep, name = path.rpartition('/')
+        paths_by_dir[parent or sep or '.'][name] = path
     missing_paths = set()
-    with Progress(console=console) as progress:
-        task = progress.add_task("[green]Проверка файлов...", total=len(all_dest_paths))
-        for path in all_dest_paths:
-            if not os.path.exists(path):
-                missing_paths.add(path)
-            progress.update(task, advance=1)
+    with Progress(console=console) as progress, ThreadPoolExecutor(max_workers=VERIFY_THREADS) as pool:
+        task = progress.add_task("[green]Проверка файлов...", total=sum(len(paths) for paths in paths_by_dir.values()))
+        for paths, missing in pool.map(_find_missing_in_dir, paths_by_dir.keys(), paths_by_dir.values()):
+            missing_paths.update(missing)
+            progress.update(task, advance=len(paths))
     console.rule("[bold]Отчет по верификации[/bold]")
     verification_table = Table(title="Детализация верификации по каталогам", padding=(0, 1))
     verification_table.add_column("Общий каталог", style="magenta", no_wrap=True)
@@ -118,7 +151,7 @@ def _run_verification(stats_data):
         do_save = questionary.confirm("Сохранить список отсутствующих файлов?").ask()
         if do_save:
             output_file = "physically_missing.csv"
-            with open(output_file, 'w', newline='', encoding='utf-8') as f:
+            with open(output_file, 'w', newline='', encoding='utf-8', buffering=WRITE_BUFFER_SIZE) as f:
                 writer = csv.writer(f); writer.writerow(['missing_destination_path'])
                 for path in sorted(missing_paths): writer.writerow([path])
             console.print(f"✅ Список сохранен в [bold cyan]{output_file}[/bold cyan].")
@@ -141,8 +174,8 @@ def handle_stats_and_verify():
     stats_data = defaultdict(lambda: {"in_source": False, "destinations": defaultdict(list)})
     for p in source_paths: stats_data[normalize_directory_path(os.path.dirname(p))]["in_source"] = True
     for p in dest_paths:
-        norm_dir = normalize_directory_path(os.path.dirname(p))
-        parts = Path(p).parts; disk = f"/{parts[1]}/{parts[2]}" if len(parts) > 2 and parts[1] == 'mnt' else "unknown"
+        dir_path = os.path.dirname(p)
+        norm_dir = normalize_directory_path(dir_path); disk = _destination_disk(dir_path)
         stats_data[norm_dir]["destinations"][disk].append(p)
     console.clear(); console.rule(f"[bold]Статистика для [cyan]{os.path.basename(map_file_path)}[/cyan][/bold]")
     summary_text = (f"Обработано записей (исходных файлов): [cyan]{len(rows):,}[/cyan]\n" f"Создано физических файлов/архивов: [green bold]{len(dest_paths):,}[/green bold]")
@@ -190,7 +223,7 @@ def handle_merge():
     output_filepath = Path(maps_dir_path) / "mapping_master.csv"
     if questionary.confirm(f"Сохранить {len(all_unique_mappings):,} записей в файл '{output_filepath}'?").ask():
         sorted_mappings = sorted(list(all_unique_mappings))
-        with open(output_filepath, 'w', newline='', encoding='utf-8') as f:
+        with open(output_filepath, 'w', newline='', encoding='utf-8', buffering=WRITE_BUFFER_SIZE) as f:
             writer = csv.writer(f); writer.writerow(['source_path', 'destination_path']); writer.writerows(sorted_mappings)
         console.print(f"✅ Успешно сохранено в: [bold cyan]{output_filepath}[/bold cyan]")
     else: console.print("[yellow]Слияние отменено пользователем.[/yellow]")
@@ -229,7 +262,7 @@ def handle_analyze():
     if missing_files_abs:
         output_file = "missing_for_copy.csv"
         console.print(f"\nСохранение списка из {len(missing_files_abs):,} необработанных файлов в [bold cyan]{output_file}[/bold cyan]...")
-        with open(output_file, 'w', newline='', encoding='utf-8') as f:
+        with open(output_file, 'w', newline='', encoding='utf-8', buffering=WRITE_BUFFER_SIZE) as f:
             writer = csv.writer(f, delimiter=';')
             for abs_path in missing_files_abs:
                 rel_path = os.path.relpath(abs_path, source_root) if source_root else abs_path
@@ -289,16 +322,13 @@ def handle_plan_vs_map():
             output_format = questionary.select("В каком формате сохранить?", choices=["Простой список (.txt)", "Готовый файл-задание (.csv) для copeer.py"]).ask()
             if output_format == "Простой список (.txt)":
                 output_file = "plan_missing_in_map.txt"
-                with open(output_file, 'w', encoding='utf-8') as f:
-                    for path in sorted(list(missing_from_map_paths)):
-                        f.write(f"{path}\n")
+                with open(output_file, 'w', encoding='utf-8', buffering=WRITE_BUFFER_SIZE) as f:
+                    f.writelines(f"{path}\n" for path in sorted(missing_from_map_paths))
                 console.print(f"✅ Список сохранен в [bold cyan]{output_file}[/bold cyan].")
             else:
                 output_file = "remaining_for_copy.csv"
-                with open(output_file, 'w', encoding='utf-8') as f:
-                    for path in sorted(list(missing_from_map_paths)):
-                        if path in plan_data:
-                            f.write(f"{plan_data[path]}\n")
+                with open(output_file, 'w', encoding='utf-8', buffering=WRITE_BUFFER_SIZE) as f:
+                    f.writelines(f"{plan_data[path]}\n" for path in sorted(missing_from_map_paths) if path in plan_data)
                 console.print(f"✅ Готовый файл-задание сохранен в [bold cyan]{output_file}[/bold cyan].")
 
 
@@ -396,7 +426,7 @@ def handle_filter_map_by_plan():
         do_save = questionary.confirm(f"Сохранить отфильтрованные записи в новый файл '{output_filename}'?").ask()
         if do_save:
             try:
-                with open(output_filename, 'w', newline='', encoding='utf-8') as f:
+                with open(output_filename, 'w', newline='', encoding='utf-8', buffering=WRITE_BUFFER_SIZE) as f:
                     writer = csv.writer(f)
                     writer.writerow(header)
                     writer.writerows(kept_rows)
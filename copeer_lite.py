@@ -3,17 +3,24 @@
 
 import argparse
 import csv
+import errno
+import gc
+import grp
 import logging
+import multiprocessing
 import os
+import pwd
 import re
 import subprocess
 import sys
 import tarfile
 import time
 import yaml
-from collections import defaultdict
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from pathlib import Path
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from itertools import repeat
+from operator import itemgetter
 from threading import Lock, get_ident
 
 # --- Настройка логирования ---
@@ -33,39 +40,73 @@ DEFAULT_CONFIG = {
     'state_file': "copier_state.csv",
     'mapping_file': "mapping.csv",
     'error_log_file': "errors.log",
+    'malformed_lines_file': "malformed_lines.log",
     'dry_run_mapping_file': "dry_run_mapping.csv",
     'dry_run': False,
     'threads': 8,
+    'disk_strategy': "fill", # или balanced - каждое задание на наименее заполненный диск
     'min_files_for_sequence': 50,
+    'rsync_batch_size': 512,
+    'rsync_batch_max_file_size': 1048576, # Файлы меньше этого размера (байт) объединяются в пакеты
+    'verify_checksum': False, # rsync --checksum при докопировании (медленно: читает файлы целиком)
     'image_extensions': ['dpx', 'cri', 'tiff', 'tif', 'exr', 'png', 'jpg', 'jpeg', 'tga', 'j2c'],
 }
-SEQUENCE_RE = re.compile(r'^(.*?)[\._]*(\d+)\.([a-zA-Z0-9]+)$', re.IGNORECASE)
+MALFORMED_PREVIEW_LINES = 10 # Сколько некорректных строк CSV показывать в отчете
+TAR_BUFSIZE = 2 << 20 # Размер буферов записи и копирования при архивации
+TAR_READER_THREADS = 2 # Потоки, заранее открывающие файлы секвенции
+TAR_PREFETCH_FILES = 4 # Сколько файлов секвенции держать открытыми наперед
+FRAME_DIGITS = '0123456789' # Символы номера кадра в имени файла секвенции
+UNSAFE_NAME_CHARS_RE = re.compile(r'[^\w\.\-]') # Символы, заменяемые на '_' в имени архива секвенции
+PROGRESS_LOG_INTERVAL = 2.0 # Как часто (сек) писать в лог общий прогресс выполнения
+DISK_USAGE_TTL = 2.0 # Сколько секунд считать результат os.statvfs актуальным
+COPY_CHUNK_SIZE = 1 << 22 # Сколько байт копировать за один вызов os.copy_file_range
 file_lock = Lock()
+_created_dirs, _created_dirs_lock = set(), Lock() # Каталоги назначения, уже созданные этим процессом
 
 
 # --- Основные классы и функции ---
 
 class DiskManager:
-    """Управляет выбором диска для записи, чтобы не превышать порог заполнения."""
-    def __init__(self, mount_points, threshold):
+    """
+    Управляет выбором диска для записи, чтобы не превышать порог заполнения.
+    Стратегия 'fill' пишет на один диск до порога, 'balanced' - на наименее заполненный.
+    """
+    def __init__(self, mount_points, threshold, strategy='fill'):
         self.mount_points = mount_points
         self.threshold = threshold
+        self.strategy = strategy
         self.active_disk = None
         self.lock = Lock()
+        self._usage_cache = {} # путь -> (время замера, результат os.statvfs)
+        self._assigned = {} # путь -> байты, отданные заданиям после последнего замера statvfs
+        # Точки монтирования не меняются во время работы - проверяем их наличие один раз
+        self._existing_mounts = [m for m in mount_points if os.path.exists(m)]
         self._select_initial_disk()
 
+    def _statvfs(self, path):
+        """Возвращает os.statvfs(path), кэшируя результат на DISK_USAGE_TTL секунд."""
+        now = time.monotonic()
+        cached = self._usage_cache.get(path)
+        if cached and now - cached[0] < DISK_USAGE_TTL:
+            return cached[1]
+        st = os.statvfs(path)
+        self._usage_cache[path] = (now, st)
+        self._assigned[path] = 0 # Свежий замер уже учитывает записанное
+        return st
+
     def _get_disk_usage(self, path):
-        if not os.path.exists(path): return 0.0
+        """Заполнение диска в процентах с учетом заданий, выданных после последнего замера."""
+        if path not in self._existing_mounts: return 0.0
         try:
-            st = os.statvfs(path)
-            used = (st.f_blocks - st.f_bfree) * st.f_frsize
+            st = self._statvfs(path)
+            used = (st.f_blocks - st.f_bfree) * st.f_frsize + self._assigned.get(path, 0)
             total = st.f_blocks * st.f_frsize
             return round(used / total * 100, 2) if total > 0 else 0
         except FileNotFoundError: return 100
 
     def _select_initial_disk(self):
         for mount in self.mount_points:
-            if not os.path.exists(mount):
+            if mount not in self._existing_mounts:
                 log.warning(f"Точка монтирования {mount} не существует. Пропускаю.")
                 continue
             if self._get_disk_usage(mount) < self.threshold:
@@ -75,23 +116,36 @@ class DiskManager:
         log.error("🛑 Не найдено подходящих дисков для начала работы.")
         raise RuntimeError("Не найдено подходящих дисков")
 
-    def get_current_destination(self):
+    def get_current_destination(self, job_size=0):
         with self.lock:
-            if not self.active_disk: raise RuntimeError("🛑 Нет доступных дисков.")
-            if self._get_disk_usage(self.active_disk) >= self.threshold:
-                log.warning(f"Диск {self.active_disk} заполнен. Ищу следующий...")
-                available_disks = [m for m in self.mount_points if os.path.exists(m)]
-                try:
-                    current_index = available_disks.index(self.active_disk)
-                    next_disks = available_disks[current_index + 1:] + available_disks[:current_index]
-                except (ValueError, IndexError):
-                    next_disks = available_disks
-                self.active_disk = next((m for m in next_disks if self._get_disk_usage(m) < self.threshold), None)
-                if self.active_disk:
-                    log.info(f"Переключился на диск: {self.active_disk}")
-            if not self.active_disk:
+            disk = self._select_destination()
+            self._assigned[disk] = self._assigned.get(disk, 0) + job_size
+            return disk
+
+    def _select_destination(self):
+        """Выбирает диск по стратегии; вызывается под self.lock."""
+        if self.strategy == 'balanced':
+            # Worst-fit: каждое задание - на наименее заполненный диск ниже порога
+            usage = [(self._get_disk_usage(m), m) for m in self._existing_mounts]
+            candidates = [item for item in usage if item[0] < self.threshold]
+            if not candidates:
                 raise RuntimeError("🛑 Нет доступных дисков: все переполнены или недоступны.")
-            return self.active_disk
+            return min(candidates)[1]
+        if not self.active_disk: raise RuntimeError("🛑 Нет доступных дисков.")
+        if self._get_disk_usage(self.active_disk) >= self.threshold:
+            log.warning(f"Диск {self.active_disk} заполнен. Ищу следующий...")
+            available_disks = self._existing_mounts
+            try:
+                current_index = available_disks.index(self.active_disk)
+                next_disks = available_disks[current_index + 1:] + available_disks[:current_index]
+            except (ValueError, IndexError):
+                next_disks = available_disks
+            self.active_disk = next((m for m in next_disks if self._get_disk_usage(m) < self.threshold), None)
+            if self.active_disk:
+                log.info(f"Переключился на диск: {self.active_disk}")
+        if not self.active_disk:
+            raise RuntimeError("🛑 Нет доступных дисков: все переполнены или недоступны.")
+        return self.active_disk
 
 def load_config():
     """Загружает конфигурацию из YAML файла или создает его по умолчанию."""
@@ -109,60 +163,299 @@ def load_config():
     config['image_extensions'] = set(e.lower() for e in config.get('image_extensions', []))
     return config
 
+def ensure_dir(path):
+    """
+    Создает каталог назначения, если он еще не создавался в этом процессе. Повторный
+    вызов для того же каталога не обращается к файловой системе (makedirs делает stat
+    каждого предка). Гонка безобидна: двойной makedirs с exist_ok=True ничего не ломает.
+    """
+    if path not in _created_dirs:
+        os.makedirs(path, exist_ok=True)
+        with _created_dirs_lock: _created_dirs.add(path)
+
+def csv_line(*fields):
+    """Кодирует строку CSV в байты так же, как csv.writer (QUOTE_MINIMAL, CRLF), но без модуля csv."""
+    quoted = []
+    for field in fields:
+        if '"' in field or ',' in field or '\n' in field or '\r' in field:
+            field = '"' + field.replace('"', '""') + '"'
+        quoted.append(field)
+    return (','.join(quoted) + '\r\n').encode('utf-8')
+
 def load_previous_state(state_file):
     """Загружает ключи уже обработанных элементов для возобновления работы."""
     processed = set()
     if os.path.exists(state_file):
         try:
-            with open(state_file, 'r', encoding='utf-8') as f:
-                processed.update(row[0] for row in csv.reader(f) if row)
+            # Файл читается и декодируется целиком, а не построчно
+            with open(state_file, 'rb') as f:
+                text = f.read().decode('utf-8')
+            lines = text.replace('\r\n', '\n').split('\n')
+            if '"' not in text and ',' not in text:
+                # Обычный случай: в каждой строке только ключ - строки и есть ключи
+                processed.update(lines)
+                processed.discard('')
+            else:
+                for line in lines:
+                    if not line: continue
+                    if line.startswith('"'):
+                        # Поле в кавычках (путь с запятой или кавычкой) - разбираем как CSV
+                        processed.add(next(csv.reader([line]))[0])
+                    else:
+                        processed.add(line.partition(',')[0])
             log.info(f"Загружено {len(processed)} записей из файла состояния.")
         except Exception as e:
             log.error(f"Не удалось прочитать файл состояния {state_file}: {e}")
     return processed
 
-def write_log(state_file, mapping_file, key, dest_path, is_dry_run):
-    """Потокобезопасная запись в лог-файлы."""
+def _write_all(fd, data):
+    """Записывает буфер в fd целиком, повторяя os.write при частичной записи."""
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+def _fadvise(fd, advice):
+    """Вызывает os.posix_fadvise(fd, 0, 0, os.<advice>) для всего файла; где его нет (macOS), ничего не делает."""
+    if hasattr(os, 'posix_fadvise'):
+        try: os.posix_fadvise(fd, 0, 0, getattr(os, advice))
+        except OSError: pass
+
+def _is_up_to_date(src_stat, dst):
+    """Быстрая проверка, как у rsync без --checksum: файл назначения совпадает с источником по размеру и mtime."""
+    try:
+        dst_stat = os.stat(dst)
+    except FileNotFoundError:
+        return False
+    return dst_stat.st_size == src_stat.st_size and int(dst_stat.st_mtime) == int(src_stat.st_mtime)
+
+def copy_file(src, dst):
+    """
+    Копирует файл без запуска rsync: os.copy_file_range (в ядре), с откатом на чтение блоками.
+    Переносятся права и mtime (владелец и группа - нет, символические ссылки разыменовываются);
+    совпадающий по размеру и mtime файл пропускается. Если источник укоротился во время
+    копирования, выбрасывается OSError, а не остается обрезанный файл.
+    """
+    src_stat = os.stat(src)
+    if _is_up_to_date(src_stat, dst): return False
+    size = src_stat.st_size
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        _fadvise(src_fd, 'POSIX_FADV_SEQUENTIAL')
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            done = 0
+            try:
+                while done < size:
+                    copied = os.copy_file_range(src_fd, dst_fd, min(COPY_CHUNK_SIZE, size - done))
+                    if copied == 0: break
+                    done += copied
+            except (AttributeError, OSError) as e:
+                # copy_file_range нет в этой ОС/ядре или он не работает между разными ФС
+                if isinstance(e, OSError) and e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP): raise
+                os.lseek(src_fd, 0, os.SEEK_SET)
+                os.lseek(dst_fd, 0, os.SEEK_SET)
+                os.ftruncate(dst_fd, 0)
+                done = 0
+            # Остаток (или весь файл) дочитывается с текущей позиции: copy_file_range
+            # на некоторых ФС (FUSE, CIFS, overlay) возвращает 0 раньше конца файла
+            while done < size and (chunk := os.read(src_fd, min(COPY_CHUNK_SIZE, size - done))):
+                _write_all(dst_fd, chunk)
+                done += len(chunk)
+            if done < size: raise OSError(f"Файл изменился во время копирования (прочитано {done} из {size} байт)")
+            os.fchmod(dst_fd, src_stat.st_mode & 0o7777)
+            os.utime(dst_fd, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+        finally:
+            os.close(dst_fd)
+        # Источник читается один раз - не вытесняем им из кэша страниц полезные данные
+        _fadvise(src_fd, 'POSIX_FADV_DONTNEED')
+    finally:
+        os.close(src_fd)
+    return True
+
+def copy_batch(source_files, dir_path, dest_dir, verify_checksum):
+    """
+    Копирует пакет файлов одного каталога в dest_dir; ошибка одного файла не прерывает пакет.
+    Возвращает (скопированные файлы, [(файл, ошибка), ...]). С verify_checksum пакет отдается
+    одному rsync --checksum, а при его ошибке файлы повторяются по одному.
+    """
+    if verify_checksum:
+        # Список имен передается через stdin
+        file_list = b'\0'.join(os.fsencode(os.path.basename(name)) for name in source_files)
+        rsync_cmd = ["rsync", "-a", "--checksum", "--from0", "--files-from=-", os.path.join(dir_path or '.', ''), dest_dir + os.sep]
+        try:
+            subprocess.run(rsync_cmd, input=file_list, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            return list(source_files), []
+        except subprocess.CalledProcessError:
+            pass # rsync не сообщает, какие именно файлы не удались
+    copied, failed = [], []
+    for source_file in source_files:
+        dest_file = os.path.join(dest_dir, os.path.basename(source_file))
+        try:
+            if verify_checksum:
+                subprocess.run(["rsync", "-a", "--checksum", source_file, dest_file], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            else:
+                copy_file(source_file, dest_file)
+            copied.append(source_file)
+        except (OSError, subprocess.CalledProcessError) as e:
+            failed.append((source_file, e))
+    return copied, failed
+
+def log_file_errors(config, failures):
+    """Дописывает в error_log_file по строке на каждую пару (исходный файл, ошибка)."""
     with file_lock:
-        if not is_dry_run:
-            with open(state_file, "a", newline='', encoding='utf-8') as f:
-                csv.writer(f).writerow([key])
-        if dest_path:
-            with open(mapping_file, "a", newline='', encoding='utf-8') as f:
-                csv.writer(f).writerow([key, dest_path])
+        with open(config['error_log_file'], "a", encoding='utf-8') as f:
+            for source_file, error in failures:
+                f.write(f"{time.asctime()};{source_file};{error}\n")
+
+def open_log_files(config, is_dry_run):
+    """
+    Открывает файлы состояния и маппинга на все время работы и возвращает их дескрипторы
+    (O_APPEND). В dry-run режиме состояние не пишется, а маппинг идет в dry_run_mapping_file.
+    """
+    flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT
+    state_fd = None if is_dry_run else os.open(config['state_file'], flags, 0o644)
+    mapping_fd = os.open(config['dry_run_mapping_file'] if is_dry_run else config['mapping_file'], flags, 0o644)
+    return state_fd, mapping_fd
+
+def write_log(state_fd, mapping_fd, keys, dest_paths, is_dry_run):
+    """
+    Записывает ключи одного задания: один os.write на каждый файл. Вызывается только
+    из главного потока (цикл as_completed), поэтому блокировка не нужна.
+    """
+    state_blob = b''.join(csv_line(key) for key in keys) if not is_dry_run else b''
+    mapping_blob = b''.join(csv_line(key, dest_path) for key, dest_path in zip(keys, dest_paths))
+    if state_blob: _write_all(state_fd, state_blob)
+    if mapping_blob: _write_all(mapping_fd, mapping_blob)
 
 def find_sequences(dirs, config):
     """Находит все последовательности в сгруппированных по каталогам файлах."""
     all_sequences, sequence_files = [], set()
+    image_extensions = config.get('image_extensions', set())
+    min_files = config.get('min_files_for_sequence', 50)
     for dir_path, files_with_sizes in dirs.items():
         sequences_in_dir = defaultdict(list)
+        # Храним (кадр, имя, размер); полный путь собирается только для найденных секвенций
         for filename, file_size in files_with_sizes:
-            match = SEQUENCE_RE.match(filename)
-            if match and match.group(3).lower() in config.get('image_extensions', set()):
-                prefix, frame, ext = match.groups()
-                full_path = os.path.join(dir_path, filename)
-                sequences_in_dir[(prefix, ext.lower())].append((int(frame), full_path, file_size))
+            # Имя вида "<префикс>[._]<кадр>.<расширение>" разбирается строковыми операциями:
+            # расширение - после последней точки, кадр - цифры в конце основы имени
+            stem, dot, ext = filename.rpartition('.')
+            if not dot: continue
+            ext = ext.lower()
+            if ext not in image_extensions: continue
+            head = stem.rstrip(FRAME_DIGITS)
+            if len(head) == len(stem): continue
+            sequences_in_dir[(head.rstrip('._'), ext)].append((int(stem[len(head):]), filename, file_size))
+        dir_prefix = os.path.join(dir_path, '')
         for (prefix, ext), file_tuples in sequences_in_dir.items():
-            if len(file_tuples) >= config.get('min_files_for_sequence', 50):
+            if len(file_tuples) >= min_files:
                 file_tuples.sort()
-                frames, full_paths, sizes = zip(*file_tuples)
-                min_frame, max_frame = min(frames), max(frames)
-                safe_prefix = re.sub(r'[^\w\.\-]', '_', prefix.strip())
+                min_frame, max_frame = file_tuples[0][0], file_tuples[-1][0]
+                full_paths = [dir_prefix + filename for _, filename, _ in file_tuples]
+                safe_prefix = UNSAFE_NAME_CHARS_RE.sub('_', prefix.strip())
                 tar_filename = f"{safe_prefix}.{min_frame:04d}-{max_frame:04d}.{ext}.tar"
-                virtual_tar_path = os.path.join(dir_path, tar_filename)
-                all_sequences.append({'type': 'sequence', 'key': virtual_tar_path, 'dir_path': dir_path, 'tar_filename': tar_filename, 'source_files': list(full_paths), 'size': sum(sizes)})
+                virtual_tar_path = dir_prefix + tar_filename
+                all_sequences.append({'type': 'sequence', 'key': virtual_tar_path, 'dir_path': dir_path, 'tar_filename': tar_filename, 'source_files': full_paths, 'size': sum(t[2] for t in file_tuples)})
                 sequence_files.update(full_paths)
     return all_sequences, sequence_files
 
+@lru_cache(maxsize=None)
+def _owner_names(uid, gid):
+    """Имена владельца и группы для заголовка tar. Кэшируются: у кадров секвенции они одни и те же."""
+    try: uname = pwd.getpwuid(uid).pw_name
+    except KeyError: uname = ""
+    try: gname = grp.getgrgid(gid).gr_name
+    except KeyError: gname = ""
+    return uname, gname
+
+def _open_tar_member(file_path):
+    """
+    Открывает файл секвенции и строит для него TarInfo по одному fstat открытого файла,
+    без повторного разбора пути и поиска имен владельца на каждый кадр (как в gettarinfo).
+    Возвращает None, если файла нет.
+    """
+    try:
+        fileobj = open(file_path, 'rb', buffering=TAR_BUFSIZE)
+    except FileNotFoundError:
+        return None
+    try:
+        st = os.fstat(fileobj.fileno())
+        _fadvise(fileobj.fileno(), 'POSIX_FADV_SEQUENTIAL')
+    except OSError:
+        fileobj.close()
+        raise
+    tarinfo = tarfile.TarInfo(os.path.basename(file_path))
+    tarinfo.size, tarinfo.mtime, tarinfo.mode = st.st_size, st.st_mtime, st.st_mode & 0o7777
+    tarinfo.uid, tarinfo.gid = st.st_uid, st.st_gid
+    tarinfo.uname, tarinfo.gname = _owner_names(st.st_uid, st.st_gid)
+    return tarinfo, fileobj
+
 def archive_sequence_to_destination(job, dest_tar_path):
-    """Создает tar-архив из файлов секвенции."""
-    os.makedirs(os.path.dirname(dest_tar_path), exist_ok=True)
-    with tarfile.open(dest_tar_path, "w") as tar:
-        for file_path in job['source_files']:
-            if os.path.exists(file_path):
-                tar.add(file_path, arcname=os.path.basename(file_path))
-            else:
+    """
+    Создает tar-архив из файлов секвенции. Архив пишется в потоковом режиме ("w|")
+    с буферами TAR_BUFSIZE, чтобы большие кадры копировались крупными блоками.
+    Открытие и stat следующих файлов идут в TAR_READER_THREADS потоках, пока
+    текущий файл пишется в архив; порядок файлов в архиве сохраняется.
+    """
+    ensure_dir(os.path.dirname(dest_tar_path))
+    with open(dest_tar_path, 'wb', buffering=TAR_BUFSIZE) as out, \
+            tarfile.open(fileobj=out, mode="w|", bufsize=TAR_BUFSIZE, format=tarfile.GNU_FORMAT, copybufsize=TAR_BUFSIZE) as tar, \
+            ThreadPoolExecutor(max_workers=TAR_READER_THREADS) as readers:
+        pending = deque()
+
+        def write_next():
+            file_path, future = pending.popleft()
+            member = future.result()
+            if member is None:
                 log.warning(f"В секвенции не найден файл: {file_path}")
+                return
+            tarinfo, fileobj = member
+            with fileobj:
+                tar.addfile(tarinfo, fileobj)
+                _fadvise(fileobj.fileno(), 'POSIX_FADV_DONTNEED') # Кадр уже в архиве
+
+        try:
+            for file_path in job['source_files']:
+                pending.append((file_path, readers.submit(_open_tar_member, file_path)))
+                if len(pending) > TAR_PREFETCH_FILES:
+                    write_next()
+            while pending:
+                write_next()
+        finally:
+            # При ошибке закрываем файлы, которые успели открыть наперед
+            for _, future in pending:
+                if not future.cancel() and future.exception() is None and future.result():
+                    future.result()[1].close()
+
+def assign_rel_paths(jobs, source_root):
+    """Записывает в каждое задание путь его ключа относительно корня источника ('rel_path')."""
+    source_prefix = os.path.join(os.path.normpath(source_root), '') if source_root else None
+    for job in jobs:
+        key = job['key']
+        if source_prefix and key.startswith(source_prefix): job['rel_path'] = key[len(source_prefix):]
+        elif source_prefix and key + os.sep == source_prefix: job['rel_path'] = ''
+        else: job['rel_path'] = key.lstrip(os.sep)
+
+def batch_file_jobs(jobs, batch_size, max_file_size):
+    """
+    Объединяет задания на копирование мелких (меньше max_file_size) файлов из одного каталога
+    в пакеты, каждый из которых обрабатывается одним заданием (copy_batch). Крупные файлы
+    остаются отдельными заданиями.
+    """
+    batched_jobs, files_by_dir = [], defaultdict(list)
+    for job in jobs:
+        if job['type'] == 'file' and job['size'] < max_file_size:
+            files_by_dir[os.path.dirname(job['key'])].append(job)
+        else:
+            batched_jobs.append(job)
+    for dir_path, file_jobs in files_by_dir.items():
+        for i in range(0, len(file_jobs), batch_size):
+            chunk = file_jobs[i:i + batch_size]
+            if len(chunk) == 1:
+                batched_jobs.append(chunk[0])
+                continue
+            batched_jobs.append({'type': 'batch', 'key': dir_path, 'dir_path': dir_path, 'source_files': [j['key'] for j in chunk], 'size': sum(j['size'] for j in chunk)})
+    batched_jobs.sort(key=itemgetter('size'), reverse=True)
+    return batched_jobs
 
 # --- Логика анализа и выполнения ---
 
@@ -171,59 +464,68 @@ def analyze_and_plan_jobs(input_csv_path, config, processed_items_keys):
     log.info("--- Шаг 1: Анализ и планирование ---")
     log.info(f"Анализ файла: {input_csv_path}")
 
-    parser_primary = re.compile(r'^"([^"]+)","([^"]+)",.*')
-    parser_fallback = re.compile(r'^"([^"]+\.\w{2,5})",.*', re.IGNORECASE)
-
     dirs, all_files_from_csv = defaultdict(list), {}
     source_root = config.get('source_root')
     if source_root:
         log.info(f"Используется корень источника: {source_root}")
-
-    lines_total, lines_ignored_dirs, malformed_lines = 0, 0, []
-
-    with open(input_csv_path, 'r', encoding='utf-8', errors='ignore') as f:
-        for line in f:
+    # Корень нормализуется один раз; для "чистых" относительных путей normpath в цикле не нужен
+    source_prefix = os.path.join(os.path.normpath(source_root), '') if source_root else None
+
+    # Некорректные строки пишутся в файл; в памяти остаются только первые для отчета
+    lines_total, lines_ignored_dirs, malformed_count, malformed_lines = 0, 0, 0, []
+
+    with open(input_csv_path, 'r', encoding='utf-8', errors='ignore', newline='', buffering=1 << 20) as f, \
+         open(config['malformed_lines_file'], 'w', encoding='utf-8', buffering=1 << 16) as malformed_file:
+        # В некоторых выгрузках кавычки удвоены по всей строке (""путь"",""тип"",...):
+        # такие строки, как и раньше, приводятся к обычному CSV до разбора
+        lines = (line.replace('""', '"') if line.startswith('""') else line for line in f)
+        for row in csv.reader(lines):
             lines_total += 1
-            cleaned_line = line.strip().replace('""', '"')
-            if not cleaned_line: continue
+            if not row: continue
 
             rel_path, file_type, size = None, "", 0
-            match = parser_primary.match(cleaned_line)
-            if match:
-                rel_path, file_type = match.groups()
-            else:
-                match = parser_fallback.match(cleaned_line)
-                if match: rel_path, file_type = match.group(1), "file"
+            if len(row) >= 3 and row[0] and row[1]:
+                rel_path, file_type = row[0], row[1]
+            elif len(row) >= 2 and 2 <= len(row[0].rpartition('.')[2]) <= 5 and '.' in row[0]:
+                # Строка без колонки типа, но с похожим на файл путем
+                rel_path, file_type = row[0], "file"
 
             if rel_path:
                 if 'directory' in file_type:
                     lines_ignored_dirs += 1
                     continue
 
-                size_match = re.search(r',"(\d+)"$', cleaned_line)
-                if size_match:
-                    try: size = int(size_match.group(1))
-                    except (ValueError, IndexError): size = 0
-
-                absolute_source_path = os.path.normpath(os.path.join(source_root, rel_path) if source_root else rel_path)
-                path_obj = Path(absolute_source_path)
-                dirs[str(path_obj.parent)].append((path_obj.name, size))
+                size_str = row[-1]
+                # isdigit пропускает и символы вроде '²', на которых int() падает
+                if size_str.isascii() and size_str.isdigit(): size = int(size_str)
+
+                if source_prefix and rel_path and not rel_path.startswith(('/', '.')) and '/.' not in rel_path and '//' not in rel_path and not rel_path.endswith('/'):
+                    absolute_source_path = source_prefix + rel_path
+                else:
+                    absolute_source_path = os.path.normpath(os.path.join(source_root, rel_path) if source_root else rel_path)
+                # Каталог и имя отделяются строковой операцией, без разбора пути через Path
+                parent, sep, name = absolute_source_path.rpartition(os.sep)
+                # У голого имени файла (без source_root) каталог - '', чтобы ключи кадров совпали с исходными путями
+                dirs[parent or sep].append((name, size))
                 all_files_from_csv[absolute_source_path] = size
             else:
-                malformed_lines.append((lines_total, line))
+                line = ','.join(row)
+                malformed_file.write(f"{lines_total}\t{line}\n")
+                if malformed_count < MALFORMED_PREVIEW_LINES: malformed_lines.append((lines_total, line))
+                malformed_count += 1
 
     sequences, sequence_files = find_sequences(dirs, config)
     standalone_files = set(all_files_from_csv.keys()) - sequence_files
 
     jobs = sequences + [{'type': 'file', 'key': f, 'size': all_files_from_csv[f]} for f in standalone_files]
     jobs_to_process = [job for job in jobs if job['key'] not in processed_items_keys]
-    jobs_to_process.sort(key=lambda j: j.get('size', 0), reverse=True)
+    jobs_to_process.sort(key=itemgetter('size'), reverse=True)
 
     # --- Вывод текстового отчета ---
     print("\n--- Отчет по анализу ---")
     print(f"Всего строк в CSV файле:             {lines_total:,}")
     print(f"  Пропущено (директории):          {lines_ignored_dirs:,}")
-    print(f"  Пропущено (неопознанный формат): {len(malformed_lines):,}")
+    print(f"  Пропущено (неопознанный формат): {malformed_count:,}")
     print(f"Найдено файлов для обработки:        {len(all_files_from_csv):,}")
     print("-" * 20)
     print(f"Заданий на архивацию:                {len(sequences):,}")
@@ -233,60 +535,95 @@ def analyze_and_plan_jobs(input_csv_path, config, processed_items_keys):
     print(f"  Пропущено (уже выполнены):       {len(jobs) - len(jobs_to_process):,}")
     print("-" * 20)
     if malformed_lines:
-        print("\n[ВНИМАНИЕ] Найдены некорректные строки (первые 10):")
-        for num, line in malformed_lines[:10]:
+        print(f"\n[ВНИМАНИЕ] Найдены некорректные строки: {malformed_count:,} (полный список в {config['malformed_lines_file']}). Первые из них:")
+        for num, line in malformed_lines:
             print(f"  Строка #{num}: {line}")
 
     return jobs_to_process
 
-def process_job_worker(job, config, disk_manager):
-    """Обрабатывает одно задание, логируя начало и конец."""
+def process_job_worker(job, config, disk_manager, archive_pool=None):
+    """
+    Обрабатывает одно задание, логируя начало и конец. В dry-run не вызывается (см. write_dry_run_mapping).
+    Если передан archive_pool, сборка tar выполняется в отдельном процессе (без GIL),
+    а поток лишь выбирает диск и ждет результата.
+    """
     thread_id = get_ident()
-    is_dry_run = config['dry_run']
     short_name = job.get('tar_filename') or os.path.basename(job['key'])
-    op_type = "Архивация" if job['type'] == 'sequence' else "Копирование"
+    op_type = {'sequence': "Архивация", 'batch': "Копирование (пакет)"}.get(job['type'], "Копирование")
+    if job['type'] == 'batch':
+        short_name = f"{short_name}/ ({len(job['source_files'])} файлов)"
 
     log.info(f"[Поток {thread_id}] Начало: {op_type} -> {short_name}")
 
     try:
-        dest_mount_point = disk_manager.get_current_destination()
-        source_root = config.get('source_root')
-        destination_root = config.get('destination_root', '/')
+        dest_mount_point = disk_manager.get_current_destination(job['size'])
         absolute_source_key = job['key']
+        # Путь относительно источника посчитан при планировании (assign_rel_paths);
+        # для пакета ключ - каталог, и dest_path получается каталогом назначения
+        dest_path = os.path.normpath(os.path.join(dest_mount_point, config['_destination_rel'], job['rel_path']))
 
-        if source_root and absolute_source_key.startswith(os.path.normpath(source_root) + os.sep):
-            rel_path = os.path.relpath(absolute_source_key, source_root)
-        else:
-            rel_path = absolute_source_key.lstrip(os.path.sep)
-
-        dest_path = os.path.normpath(os.path.join(dest_mount_point, destination_root.lstrip(os.path.sep), rel_path))
-
-        source_keys_to_log = []
+        # Копирование идет в процессе (copy_file); rsync нужен только для сверки по содержимому
+        verify_checksum = config.get('verify_checksum')
         if job['type'] == 'sequence':
-            if not is_dry_run:
-                archive_sequence_to_destination(job, dest_path)
+            if archive_pool:
+                archive_pool.submit(archive_sequence_to_destination, job, dest_path).result()
             else:
-                time.sleep(0.05)
+                archive_sequence_to_destination(job, dest_path)
             source_keys_to_log = job['source_files']
+        elif job['type'] == 'batch':
+            ensure_dir(dest_path)
+            # В лог ошибок идут только неудавшиеся файлы пакета, скопированные пишутся в состояние
+            source_keys_to_log, failed = copy_batch(job['source_files'], job['dir_path'], dest_path, verify_checksum)
+            if failed:
+                log.error(f"[Поток {thread_id}] ОШИБКА: {len(failed)} из {len(job['source_files'])} файлов пакета {short_name} не скопированы (см. {config['error_log_file']})")
+                log_file_errors(config, failed)
+                if not source_keys_to_log: return (None, 0, None, None)
         else: # 'file'
             source_keys_to_log = [absolute_source_key]
-            if not is_dry_run:
-                os.makedirs(os.path.dirname(dest_path), exist_ok=True)
-                rsync_cmd = ["rsync", "-a", "--checksum", absolute_source_key, dest_path]
-                subprocess.run(rsync_cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            ensure_dir(os.path.dirname(dest_path))
+            if verify_checksum:
+                subprocess.run(["rsync", "-a", "--checksum", absolute_source_key, dest_path], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
             else:
-                time.sleep(0.05)
+                copy_file(absolute_source_key, dest_path)
 
         log.info(f"[Поток {thread_id}] Успех: {short_name}")
         return (job['type'], job['size'], source_keys_to_log, dest_path)
 
     except Exception as e:
         log.error(f"[Поток {thread_id}] ОШИБКА при обработке {short_name}: {e}")
-        with file_lock:
-             with open(config['error_log_file'], "a", encoding='utf-8') as f:
-                f.write(f"{time.asctime()};{job['key']};{e}\n")
+        failed_keys = job['source_files'] if job['type'] == 'batch' else [job['key']]
+        log_file_errors(config, zip(failed_keys, repeat(e)))
         return (None, 0, None, None)
 
+def write_dry_run_mapping(jobs, config, disk_manager):
+    """
+    Dry-run без рабочих потоков и имитации копирования: пути назначения считаются так же,
+    как в process_job_worker (с выбором диска по стратегии), и весь отчет пишется
+    в dry_run_mapping_file одним вызовом write_log.
+    """
+    keys, dest_paths = [], []
+    for job in jobs:
+        try:
+            dest_mount_point = disk_manager.get_current_destination(job['size'])
+        except RuntimeError as e:
+            log.error(f"Dry-run остановлен на {job['key']}: {e}")
+            break
+        dest_path = os.path.normpath(os.path.join(dest_mount_point, config['_destination_rel'], job['rel_path']))
+        if job['type'] == 'file':
+            keys.append(job['key']); dest_paths.append(dest_path)
+        elif job['type'] == 'batch':
+            keys.extend(job['source_files'])
+            dest_paths.extend(os.path.join(dest_path, os.path.basename(key)) for key in job['source_files'])
+        else: # Все кадры секвенции попадают в один архив
+            keys.extend(job['source_files'])
+            dest_paths.extend(repeat(dest_path, len(job['source_files'])))
+    _, mapping_fd = open_log_files(config, True)
+    try:
+        write_log(None, mapping_fd, keys, dest_paths, True)
+    finally:
+        os.close(mapping_fd)
+    log.info(f"Dry-run: в {config['dry_run_mapping_file']} записано {len(keys):,} путей.")
+
 # --- Точка входа ---
 
 def main(args):
@@ -294,6 +631,8 @@ def main(args):
     config = load_config()
     if args.dry_run:
         config['dry_run'] = True
+    # destination_root нормализуется один раз, а не в каждом задании
+    config['_destination_rel'] = os.path.normpath(config.get('destination_root', '/')).lstrip(os.sep)
 
     log.info(f"--- Copeer v{__version__} ---")
     log.info(f"Режим: {'Dry Run' if config['dry_run'] else 'Реальная работа'}")
@@ -308,8 +647,16 @@ def main(args):
         except IOError as e:
             log.error(f"Не удалось создать файл отчета для dry-run: {e}")
 
-    processed_items_keys = load_previous_state(config['state_file'])
-    jobs_to_process = analyze_and_plan_jobs(args.input_file, config, processed_items_keys)
+    # Во время загрузки состояния и планирования циклический GC отключен: создаются миллионы
+    # долгоживущих объектов без циклов, и сборки лишь повторно обходят растущую кучу.
+    # Готовый план замораживается, чтобы сборки во время копирования его не сканировали.
+    gc.disable()
+    try:
+        processed_items_keys = load_previous_state(config['state_file'])
+        jobs_to_process = analyze_and_plan_jobs(args.input_file, config, processed_items_keys)
+    finally:
+        gc.enable()
+    gc.freeze()
     if not jobs_to_process:
         log.info("Все задания уже выполнены. Завершение.")
         return
@@ -320,30 +667,54 @@ def main(args):
         log.warning("\nВыполнение отменено пользователем.")
         return
 
-    disk_manager = DiskManager(config['mount_points'], config['threshold'])
+    disk_manager = DiskManager(config['mount_points'], config['threshold'], config.get('disk_strategy', 'fill'))
+    jobs_to_process = batch_file_jobs(jobs_to_process, config['rsync_batch_size'], config['rsync_batch_max_file_size'])
+    assign_rel_paths(jobs_to_process, config.get('source_root'))
+
+    if is_dry_run:
+        write_dry_run_mapping(jobs_to_process, config, disk_manager)
+        return
 
     log.info(f"--- Шаг 2: Выполнение {len(jobs_to_process)} заданий ---")
 
-    jobs_completed = 0
+    jobs_completed, last_progress_log = 0, 0.0
     total_jobs = len(jobs_to_process)
 
-    with ThreadPoolExecutor(max_workers=config['threads']) as executor:
-        future_to_job = {executor.submit(process_job_worker, job, config, disk_manager): job for job in jobs_to_process}
-
-        for future in as_completed(future_to_job):
-            job_type, _, source_keys, dest_path = future.result()
-
-            jobs_completed += 1
-            log.info(f"Прогресс: {jobs_completed} / {total_jobs} заданий выполнено.")
-
-            if job_type:
-                # Запись в лог-файлы
-                for key in source_keys:
-                    write_log(
-                        config['state_file'],
-                        config['dry_run_mapping_file'] if is_dry_run else config['mapping_file'],
-                        key, dest_path, is_dry_run
-                    )
+    # Секвенции архивируются в пуле процессов: сборка tar упирается в GIL, а копирование - нет.
+    # Пул создает процессы лениво, при первом submit() из рабочего потока; fork в этот момент
+    # унаследовал бы захваченные другими потоками блокировки (логирование, file_lock,
+    # _created_dirs_lock), поэтому процессы запускаются через forkserver (или spawn)
+    has_sequences = any(job['type'] == 'sequence' for job in jobs_to_process)
+    archive_pool = None
+    if has_sequences:
+        start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        archive_pool = ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context(start_method))
+
+    state_fd, mapping_fd = open_log_files(config, False)
+    try:
+        with ThreadPoolExecutor(max_workers=config['threads']) as executor:
+            future_to_job = {executor.submit(process_job_worker, job, config, disk_manager, archive_pool): job for job in jobs_to_process}
+
+            for future in as_completed(future_to_job):
+                job_type, _, source_keys, dest_path = future.result()
+
+                jobs_completed += 1
+                # Строка прогресса - не на каждое задание: на тысячах мелких заданий вывод
+                # в консоль (с flush на каждую запись) заметно тормозит главный цикл
+                now = time.monotonic()
+                if now - last_progress_log >= PROGRESS_LOG_INTERVAL or jobs_completed == total_jobs:
+                    last_progress_log = now
+                    log.info(f"Прогресс: {jobs_completed} / {total_jobs} заданий выполнено.")
+
+                if job_type:
+                    # Для пакета dest_path - это каталог назначения
+                    dest_paths = [os.path.join(dest_path, os.path.basename(key)) for key in source_keys] if job_type == 'batch' else repeat(dest_path)
+                    write_log(state_fd, mapping_fd, source_keys, dest_paths, False)
+    finally:
+        if archive_pool:
+            archive_pool.shutdown(wait=True)
+        for fd in (state_fd, mapping_fd):
+            if fd is not None: os.close(fd)
 
     log.info("--- Все задания обработаны ---")
 
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Скрипты лежат в корне репозитория и не устанавливаются как пакет
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,27 @@
+import copeer_lite
+
+
+def plan(tmp_path, manifest):
+    input_csv = tmp_path / "list.csv"
+    input_csv.write_text(manifest, encoding="utf-8")
+    config = dict(copeer_lite.DEFAULT_CONFIG, source_root="/src", image_extensions={"dpx"},
+                  malformed_lines_file=str(tmp_path / "malformed.log"))
+    jobs = copeer_lite.analyze_and_plan_jobs(str(input_csv), config, set())
+    return sorted((job['key'], job['size']) for job in jobs)
+
+
+def test_plain_manifest(tmp_path):
+    assert plan(tmp_path, '"a/q.txt","file","x","55"\n') == [("/src/a/q.txt", 55)]
+
+
+def test_doubled_quotes_manifest(tmp_path):
+    assert plan(tmp_path, '""a/q.txt"",""file"",""x"",""55""\n') == [("/src/a/q.txt", 55)]
+
+
+def test_directories_are_skipped(tmp_path):
+    manifest = '""a"",""directory"",""x"",""0""\n"a/b.txt","file","x","7"\n'
+    assert plan(tmp_path, manifest) == [("/src/a/b.txt", 7)]
+
+
+def test_non_ascii_digit_size_is_zero(tmp_path):
+    assert plan(tmp_path, '"a/q.txt","file","x","²"\n') == [("/src/a/q.txt", 0)]